@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Benchmark of the calls to the Centreon webservice: per call latency of the previous
+# implementation, which sent every call with requests.post (a new connection per call),
+# compared to the Webservice shared session, sequentially and with call_clapi_async.
+# A local stub server answers the authentication and clapi calls, after an optional
+# delay simulating the processing time of Centreon. It is plain HTTP: with HTTPS, the
+# TLS handshake saved on each call by the shared session makes the difference larger.
+#
+# Usage: python3 webservice_session.py [number of calls] [server delay in ms]
+import os, sys, time, json, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "python"))
+from centreonapi.webservice import Webservice
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def stub(delay):
+    connections = set()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # The headers and the body are written separately: send them without waiting
+        # for an ACK in between, like a real web server
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            connections.add(self.client_address)
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if "authenticate" in self.path:
+                body = json.dumps({ "authToken": "token" }).encode()
+            else:
+                time.sleep(delay)
+                body = json.dumps({ "result": [] }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = StubServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return ("http://127.0.0.1:" + str(server.server_address[1]), connections)
+
+def legacyCall(url, token, action, obj, values):
+    request = requests.post(
+        url + '/api/index.php?action=action&object=centreon_clapi',
+        headers={
+            'Content-Type': 'application/json',
+            'centreon-auth-token': token
+        },
+        data=json.dumps({ 'action': action, 'object': obj, 'values': values })
+    )
+    request.raise_for_status()
+    return request.json()
+
+def report(name, latencies, elapsed, connections):
+    latencies = sorted(latencies)
+    print("%-26s %6d calls %7.3fs  avg %7.2f ms  p50 %7.2f ms  p99 %7.2f ms  %5d connections" % (
+        name, len(latencies), elapsed, 1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * 0.99)], len(connections)))
+    connections.clear()
+
+def timed(call, count):
+    latencies = []
+    start = time.time()
+    for i in range(count):
+        callStart = time.time()
+        call(i)
+        latencies.append(time.time() - callStart)
+    return (latencies, time.time() - start)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    (url, connections) = stub(delay)
+
+    (latencies, elapsed) = timed(lambda i: legacyCall(url, "token", "show", "HOST", None), count)
+    report("requests.post per call", latencies, elapsed, connections)
+
+    webservice = Webservice.getInstance(url, "user", "password", True, 8)
+    webservice.auth()
+    (latencies, elapsed) = timed(lambda i: webservice.call_clapi("show", "HOST"), count)
+    report("shared session", latencies, elapsed, connections)
+
+    start = time.time()
+    futures = [ (time.time(), webservice.call_clapi_async("applytpl", "HOST", "host%d" % i, "host%d" % i)) for i in range(count) ]
+    latencies = []
+    for (submitted, future) in futures:
+        future.result()
+        latencies.append(time.time() - submitted)
+    report("async, from submission", latencies, time.time() - start, connections)
+    webservice.shutdown()
+    webservice.close()
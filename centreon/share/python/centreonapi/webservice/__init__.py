@@ -2,6 +2,52 @@
 
 import requests
 import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Seconds to wait for the connection to Centreon, the read timeout is configurable
+CONNECT_TIMEOUT = 10
+CLAPI_PATH = '/api/index.php?action=action&object=centreon_clapi'
+# HTTP codes of the failures worth retrying
+RETRIED_CODES = frozenset([429, 502, 503, 504])
+# HTTP codes telling that the request was not processed, any call can be retried
+NOT_PROCESSED_CODES = frozenset([429, 503])
+# clapi actions which can be repeated without changing their result: the reads, and the
+# actions setting values or applying a configuration. The other ones (add, del, addmember...)
+# are only retried when Centreon did not process them.
+IDEMPOTENT_ACTIONS = frozenset([
+    'show', 'getparam', 'getmacro', 'gettemplate', 'getparent', 'getcontact', 'getcontactgroup',
+    'gethostgroup', 'getmember', 'pollerlist', 'setparam', 'setinstance', 'setmacro', 'settemplate',
+    'setparent', 'setcontact', 'setcontactgroup', 'sethostgroup', 'setmember', 'setseverity',
+    'unsetseverity', 'enable', 'disable', 'applytpl', 'applycfg'
+])
+
+
+class CentreonUnavailable(requests.exceptions.RequestException):
+    """
+    Raised without calling Centreon Web after too many failed calls in a row
+    """
+    pass
+
+
+def requestNotSent(error):
+    """
+    Test if a connection error happened before the request was sent
+
+    :param error: The error raised by requests
+    :type error: requests.exceptions.RequestException
+    :return: If the request certainly did not reach Centreon Web
+    :rtype: Boolean
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(reason, NewConnectionError)
 
 class Webservice(object):
     """
@@ -21,9 +67,22 @@ class Webservice(object):
             Webservice.__instance.authpass = None
             Webservice.__instance.auth_token = None
             Webservice.__instance.verify = True
+            Webservice.__instance.workers = 8
+            Webservice.__instance.timeout = (CONNECT_TIMEOUT, 300)
+            Webservice.__instance.session = None
+            Webservice.__instance.executor = None
+            Webservice.__instance.lanes = {}
+            Webservice.__instance.lock = threading.Lock()
+            Webservice.__instance.authLock = threading.Lock()
+            Webservice.__instance.retries = 3
+            Webservice.__instance.backoff = 1.0
+            Webservice.__instance.max_failures = 5
+            Webservice.__instance.cooldown = 60
+            Webservice.__instance.failures = 0
+            Webservice.__instance.open_until = 0
         return Webservice.__instance
 
-    def load(self, url, username, password, verify):
+    def load(self, url, username, password, verify, workers=8, timeout=300):
         """
         Load configuration for webservices
 
@@ -35,11 +94,38 @@ class Webservice(object):
         :type password: String
         :param verify: Check Centreon certificate signature (default True)
         :type verify: Boolean
+        :param workers: The number of concurrent calls (default 8)
+        :type workers: Integer
+        :param timeout: The maximum time to wait for a response, in seconds (default 300)
+        :type timeout: Float
         """
         self.url = url
         self.authuser = username
         self.authpass = password
         self.verify = verify
+        self.workers = workers
+        self.timeout = (CONNECT_TIMEOUT, timeout)
+        # The session is created again for the new settings
+        self.session = None
+
+    def configureRetries(self, retries=3, backoff=1.0, max_failures=5, cooldown=60):
+        """
+        Configure the retries of the failed calls and the circuit breaker
+
+        :param retries: The number of retries of a failed call (default 3)
+        :type retries: Integer
+        :param backoff: The delay before the first retry, in seconds, doubled for each retry (default 1)
+        :type backoff: Float
+        :param max_failures: The number of failed calls in a row after which the calls fail
+                             without calling Centreon Web (default 5)
+        :type max_failures: Integer
+        :param cooldown: The time without calls after max_failures failed calls, in seconds (default 60)
+        :type cooldown: Float
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_failures = max_failures
+        self.cooldown = cooldown
 
     def isLoaded(self):
         """
@@ -52,19 +138,145 @@ class Webservice(object):
             return False
         return True
 
+    def getSession(self):
+        """
+        Get the HTTP session shared by all the calls to Centreon
+
+        Its connections are kept alive and reused, so that the TCP connection
+        and the TLS handshake are only made once per connection. The pool holds
+        one connection per concurrent call, and blocks the calls beyond it.
+
+        :return: The HTTP session
+        :rtype: requests.Session
+        """
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.verify = self.verify
+                self.session = session
+            return self.session
+
+    def post(self, path, **kwargs):
+        """
+        Send a POST request to Centreon Web through the shared session
+
+        :param path: The path of the request, after the Centreon Web URL
+        :type path: String
+        :return: The response
+        :rtype: requests.Response
+        """
+        return self.getSession().post(self.url + path, timeout=self.timeout, **kwargs)
+
+    def close(self):
+        """
+        Close the connections to Centreon Web
+        """
+        with self.lock:
+            session = self.session
+            self.session = None
+        if session is not None:
+            session.close()
+
+    def checkCircuit(self):
+        """
+        Fail right away when the last calls failed, until the cooldown is over.
+        After the cooldown, a single call is let through to test Centreon Web.
+        """
+        with self.lock:
+            if self.max_failures <= 0 or self.failures < self.max_failures:
+                return
+            now = time.time()
+            if now < self.open_until:
+                raise CentreonUnavailable('Centreon Web is unavailable after ' + str(self.failures) +
+                                          ' failed calls, retrying in ' + str(int(self.open_until - now)) + 's')
+            self.open_until = now + self.cooldown
+
+    def recordResult(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.max_failures > 0 and self.failures >= self.max_failures:
+                    self.open_until = time.time() + self.cooldown
+
+    def retryDelay(self, attempt):
+        """
+        Exponential backoff, with a random part so that concurrent calls are not retried at once
+        """
+        return self.backoff * (2 ** attempt) * (0.5 + random.random())
+
+    def reauth(self, token):
+        """
+        Authenticate again after the token was refused, unless another call already did
+        """
+        with self.authLock:
+            if self.auth_token == token:
+                self.auth()
+
+    def send(self, path, data, idempotent, authenticated=True):
+        """
+        Send a request to Centreon Web, authenticating again when the token is refused (401)
+        and retrying the transient failures with a backoff. The calls which are not idempotent
+        are only retried when Centreon Web did not process them.
+
+        :param path: The path of the request, after the Centreon Web URL
+        :type path: String
+        :param data: The body of the request, a dict for a form or a JSON string
+        :type data: mixed
+        :param idempotent: If the request can be repeated without changing its result
+        :type idempotent: Boolean
+        :param authenticated: If the request needs the authentication token (default True)
+        :type authenticated: Boolean
+        :return: The response
+        :rtype: requests.Response
+        """
+        self.checkCircuit()
+        reauthenticated = False
+        attempt = 0
+        while True:
+            response = None
+            token = self.auth_token
+            headers = { 'Content-Type': 'application/json', 'centreon-auth-token': token } if authenticated else None
+            try:
+                response = self.post(path, headers=headers, data=data)
+                if response.status_code == 401 and authenticated and not reauthenticated:
+                    # The token expired, the request was refused
+                    reauthenticated = True
+                    self.reauth(token)
+                    continue
+                if response.status_code not in RETRIED_CODES:
+                    break
+                retry = idempotent or response.status_code in NOT_PROCESSED_CODES
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+                if attempt >= self.retries or not (idempotent or requestNotSent(exc)):
+                    self.recordResult(False)
+                    raise
+            else:
+                if attempt >= self.retries or not retry:
+                    break
+            time.sleep(self.retryDelay(attempt))
+            attempt += 1
+        self.recordResult(response.status_code < 500 and response.status_code != 429)
+        response.raise_for_status()
+        return response
+
     def auth(self):
         """
         Authenticate to the webservices
         """
-        request = requests.post(
-            self.url + '/api/index.php?action=authenticate',
-            data={
+        request = self.send(
+            '/api/index.php?action=authenticate',
+            {
                 'username': self.authuser,
                 'password': self.authpass
             },
-            verify=self.verify
+            True,
+            False
         )
-        request.raise_for_status()
         data = request.json()
         self.auth_token = data['authToken']
 
@@ -82,7 +294,10 @@ class Webservice(object):
         :rtype: dict
         """
         if self.auth_token is None:
-            self.auth()
+            # Only one of the concurrent calls authenticates
+            with self.authLock:
+                if self.auth_token is None:
+                    self.auth()
 
         data = {}
 
@@ -93,18 +308,82 @@ class Webservice(object):
         if values is not None:
             data['values'] = values
 
-        request = requests.post(
-            self.url + '/api/index.php?action=action&object=centreon_clapi',
-            headers={
-                'Content-Type': 'application/json',
-                'centreon-auth-token': self.auth_token
-            },
-            data=json.dumps(data),
-            verify=self.verify
-        )
-        request.raise_for_status()
+        request = self.send(CLAPI_PATH, json.dumps(data), str(action).lower() in IDEMPOTENT_ACTIONS)
         return request.json()
-        
+
+    def call_clapi_async(self, action=None, obj=None, values=None, key=None):
+        """
+        Call an endpoint of Centreon Web for clapi wrapper from the thread pool
+
+        The calls made with the same key (for example a host name) are run one
+        after the other, in the order of the calls, the other ones concurrently.
+        When a call fails, the calls queued after it with the same key are not
+        sent and fail with the same error.
+
+        :param action: The clapi action
+        :type action: String
+        :param obj: The clapi object
+        :type obj: String
+        :param values: The values for the call
+        :type values: mixed
+        :param key: The calls with the same key are run in order (default None, unordered)
+        :type key: String
+        :return: The future response of call
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        task = (future, action, obj, values)
+        if key is None:
+            key = future
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            lane = self.lanes.get(key)
+            if lane is not None:
+                # The lane is being run, it will run this call too
+                lane.append(task)
+                return future
+            self.lanes[key] = deque([task])
+            executor = self.executor
+        executor.submit(self._run_lane, key)
+        return future
+
+    def _run_lane(self, key):
+        """
+        Run the calls queued for a key, until there are none
+
+        The calls following a failed one depend on it (the host was not created),
+        they fail with its error
+        """
+        error = None
+        while True:
+            with self.lock:
+                lane = self.lanes[key]
+                if len(lane) == 0:
+                    del self.lanes[key]
+                    return
+                (future, action, obj, values) = lane.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+                continue
+            try:
+                future.set_result(self.call_clapi(action, obj, values))
+            except Exception as exc:
+                error = exc
+                future.set_exception(exc)
+
+    def shutdown(self):
+        """
+        Wait for the calls in progress and stop the thread pool
+        """
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
     def restart_poller(self, poller):
         if self.auth_token is None:
             self.auth()
@@ -112,17 +391,7 @@ class Webservice(object):
         data = {}
         data['action'] = 'APPLYCFG'
         data['values'] = poller
-        request = requests.post(
-            self.url + '/api/index.php?action=action&object=centreon_clapi',
-            headers={
-                'Content-Type': 'application/json',
-                'centreon-auth-token': self.auth_token
-            },
-            data=json.dumps(data),
-            verify=self.verify
-        )
-        request.raise_for_status()
-        return request
+        return self.send(CLAPI_PATH, json.dumps(data), True)
     
     def list_pollers(self):
         if self.auth_token is None:
@@ -130,20 +399,10 @@ class Webservice(object):
 
         data = {}
         data['action'] = 'POLLERLIST'
-        request = requests.post(
-            self.url + '/api/index.php?action=action&object=centreon_clapi',
-            headers={
-                'Content-Type': 'application/json',
-                'centreon-auth-token': self.auth_token
-            },
-            data=json.dumps(data),
-            verify=self.verify
-        )
-        request.raise_for_status()
-        return request
+        return self.send(CLAPI_PATH, json.dumps(data), True)
  
     @staticmethod
-    def getInstance(url=None, username=None, password=None, verify=True):
+    def getInstance(url=None, username=None, password=None, verify=True, workers=8, timeout=300):
         """
         Get an unique instance of the webservices
 
@@ -155,11 +414,15 @@ class Webservice(object):
         :type password: String
         :param verify: Check Centreon certificate signature (default True)
         :type verify: Boolean
+        :param workers: The number of concurrent calls (default 8)
+        :type workers: Integer
+        :param timeout: The maximum time to wait for a response, in seconds (default 300)
+        :type timeout: Float
         """
         instance = Webservice()
         if instance.isLoaded():
             return instance
         if url is None or username is None or password is None:
             raise KeyError('Missing parameters to load the Webservice')
-        instance.load(url, username, password, verify)
+        instance.load(url, username, password, verify, workers, timeout)
         return instance
@@ -162,3 +162,70 @@ class Host(object):
 
     def disable(self, hostname):
         return self.webservice.call_clapi('disable', 'HOST', hostname)
+
+
+class HostOrderedCalls(object):
+    """
+    Runs the clapi calls of Host from the webservice thread pool, the calls
+    about the same host (the first of the values) in order
+    """
+
+    def __init__(self, webservice):
+        self.webservice = webservice
+        self.calls = []
+
+    def call_clapi(self, action=None, obj=None, values=None):
+        key = values[0] if isinstance(values, list) else values
+        future = self.webservice.call_clapi_async(action, obj, values, key)
+        self.calls.append((action, key, future))
+        return future
+
+
+class AsyncHost(Host):
+    """
+    Centreon Web host object whose calls are run concurrently
+
+    The methods return futures, the calls about the same host are run in the
+    order they are made, the calls about different hosts concurrently.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.webservice = HostOrderedCalls(Webservice.getInstance())
+        self.done = []
+
+    def wait(self):
+        """
+        Wait for all the calls made, raise the error of the first failed call
+
+        :return: The responses of the calls
+        :rtype: list
+        """
+        calls = self.webservice.calls
+        self.webservice.calls = []
+        self.done.extend(calls)
+        results = []
+        error = None
+        for (action, key, future) in calls:
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                if error is None:
+                    error = exc
+        if error is not None:
+            raise error
+        return results
+
+    def succeeded(self, action):
+        """
+        Hosts for which a call waited for succeeded
+
+        :param action: The action of the call
+        :type action: string
+        :return: The names of the hosts
+        :rtype: set
+        """
+        return set(key for (done, key, future) in self.done
+                   if done == action and not future.cancelled() and future.exception() is None)
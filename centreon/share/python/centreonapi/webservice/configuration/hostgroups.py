@@ -23,4 +23,20 @@ class Hostgroups(object):
     def delete(self, name):
         return self.webservice.call_clapi('del', 'HG', name)
 
+    def getmember(self, name):
+        """
+        Get the hosts of a HostGroup
+        """
+        return self.webservice.call_clapi('getmember', 'HG', name)
 
+    def addmember(self, name, hosts):
+        """
+        Add several hosts to a HostGroup at once
+        """
+        return self.webservice.call_clapi('addmember', 'HG', [name, "|".join(hosts)])
+
+    def setmember(self, name, hosts):
+        """
+        Replace the hosts of a HostGroup
+        """
+        return self.webservice.call_clapi('setmember', 'HG', [name, "|".join(hosts)])
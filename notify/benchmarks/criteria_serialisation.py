@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Benchmark of the GLPI search criteria serialisation (glpi.criterias), compared to the
+# previous implementation which concatenated unencoded strings.
+# A large criteria set is built (one criteria per node, in an OR group, like a search
+# on thousands of nodes) and serialised repeatedly, as a search template reused for
+# every report.
+#
+# Usage: python3 criteria_serialisation.py [number of criteria] [number of searches]
+import os, sys, time
+from urllib.parse import parse_qsl
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "python"))
+import glpi
+
+def legacyShow(field, searchtype, value, i):
+    sep = "criteria[" + str(i) + "]"
+    return sep + "[link]=" + "OR" + "&" + sep + "[field]=" + field + "&" + sep + "[searchtype]=" + searchtype + "&" + sep + "[value]=" + value
+
+def legacyStr(values):
+    output = ""
+    for i in range(len(values)):
+        output += legacyShow("1", "contains", values[i], i) + "&"
+    return output[:len(output)-1]
+
+def build(values):
+    filters = glpi.criterias()
+    filters.addCriteria(glpi.criteria("1", "contains", "[Rudder]Packages & updates #1"))
+    filters.addCriteria(glpi.criteriaGroup([ glpi.criteria("21", "contains", value, link="OR") for value in values ]))
+    filters.display(["2"])
+    filters.setRange(0, 0)
+    return filters
+
+def timed(name, count, function):
+    start = time.time()
+    for i in range(count):
+        function()
+    elapsed = time.time() - start
+    print("%-24s %8d searches %7.3fs %10.1f us/search" % (name, count, elapsed, elapsed * 1000000 / count))
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    values = [ " - Node UUID: node-%08d" % i for i in range(size) ]
+
+    # The encoded query must decode back to the original values
+    decoded = dict(parse_qsl(str(build(values))))
+    assert decoded["criteria[0][value]"] == "[Rudder]Packages & updates #1"
+    assert decoded["criteria[1][criteria][%d][value]" % (size - 1)] == values[-1]
+
+    timed("legacy (not encoded)", count, lambda: legacyStr(values))
+    timed("encoded, new criterias", count, lambda: str(build(values)))
+    template = build(values)
+    timed("encoded, reused template", count, lambda: str(template))
+    group = template.array[1]
+    def reusedGroup():
+        filters = glpi.criterias()
+        filters.addCriteria(glpi.criteria("1", "contains", "[Rudder]Packages"))
+        filters.addCriteria(group)
+        return str(filters)
+    timed("encoded, reused group", count, reusedGroup)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the non-compliance report parser (notify.Message)
+# on a synthetic log, compared to the previous implementation which compiled
+# its regex and built its data dict for every line.
+#
+# Usage: python3 message_parsing.py [number of lines]
+import os, re, sys, time, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "python"))
+import notify
+
+REPORT = "[2024-01-{day:02d} 10:{minute:02d}:00+00:00] N: {node} [node{index}.example.com] S: [result_error] " \
+         "R: 32377fd7-02fd-43d0-aab7-28460a91347b [Global configuration] " \
+         "D: 2b9a5d9a-1f2c-4b3e-8e0b-5a8e5a5d6a{directive:02d} [Packages {directive}] " \
+         "T: packageManagement/1.0 C: [Package] V: [vim] Package vim could not be installed"
+NOISE = "Compliance log rotated at 2024-01-01 10:00:00"
+
+def legacyParse(line):
+    regex = re.compile(r"^\[(?P<Date>[^\]]+)\] N: (?P<NodeUUID>[^ ]+) \[(?P<NodeFQDN>[^\]]+)\] S: \[(?P<Result>[^\]]+)\] R: (?P<RuleUUID>[^ ]+) \[(?P<RuleName>[^\]]+)\] D: (?P<DirectiveUUID>[^ ]+) \[(?P<DirectiveName>[^\]]+)\] T: (?P<TechniqueName>[^/]+)/(?P<TechniqueVersion>[^ ]+) C: \[(?P<ComponentName>[^\]]+)\] V: \[(?P<ComponentKey>[^\]]+)\] (?P<Message>.+)$")
+    groups = regex.search(line).groups()
+    data = dict(zip(notify.MESSAGE_FIELDS, groups))
+    rendered = " - Date: " + data["date"] + \
+        "\n - Node UUID: " + data["node_uuid"] + \
+        "\n - Node FQDN: " + data["node_fqdn"] + \
+        "\n - Result: " + data["result"] + \
+        "\n - Rule UUID: " + data["rule_uuid"] + \
+        "\n - Rule name: " + data["rule_name"] + \
+        "\n - Directive UUID: " + data["directive_uuid"] + \
+        "\n - Directive name: " + data["directive_name"] + \
+        "\n - Technique name: " + data["technique_name"] + \
+        "\n - Technique version: " + data["technique_version"] + \
+        "\n - Component name: " + data["component_name"] + \
+        "\n - Component key: " + data["component_key"] + \
+        "\n - Message: " + data["message"] + "\n"
+    return rendered.split("\n")[1]
+
+def parse(line):
+    return notify.Message(line).withoutTimeStamp()
+
+def generate(path, count):
+    with open(path, "w") as fd:
+        for i in range(count):
+            if i % 10 == 9:
+                fd.write(NOISE + "\n")
+            else:
+                fd.write(REPORT.format(day=i % 28 + 1, minute=i % 60, node="node-%08d" % (i % 10000), index=i % 10000, directive=i % 50) + "\n")
+
+def run(name, path, function):
+    parsed = 0
+    rejected = 0
+    start = time.time()
+    with open(path) as fd:
+        for line in fd:
+            try:
+                function(line.rstrip("\n"))
+                parsed += 1
+            except (ValueError, AttributeError):
+                rejected += 1
+    elapsed = time.time() - start
+    print("%-8s %9d reports %8d rejected %7.2fs %10.0f lines/s" % (name, parsed, rejected, elapsed, (parsed + rejected) / elapsed))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "non-compliant-reports.log")
+        generate(path, count)
+        run("legacy", path, legacyParse)
+        run("current", path, parse)
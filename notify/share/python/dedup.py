@@ -0,0 +1,83 @@
+import threading, time
+from collections import OrderedDict
+
+# Agents send the same non-compliance on every run (every 5 minutes by default): this cache
+# remembers when each report was last notified on each channel, to notify it at most once
+# per window on that channel.
+#  - reports are identified by Message.key(), i.e. everything but their date
+#  - reports are notified to destinations, (channel, targets) pairs, each channel has
+#    its own window in seconds, 0 to notify every report
+#  - reports whose sending failed are forgotten by the channels, see forget()
+#  - entries not seen for longer than the largest window expire, and at most max_entries
+#    are kept: the least recently seen ones are evicted first
+class reportCache:
+  def __init__(self, windows, max_entries=100000):
+    self.lock = threading.Lock()
+    # key -> [last seen, { destination: last notified }], the least recently seen first
+    self.entries = OrderedDict()
+    self.suppressed = {}
+    self.evicted = 0
+    self.configure(windows, max_entries)
+
+  def configure(self, windows, max_entries):
+    with self.lock:
+      self.windows = dict(windows)
+      self.ttl = max(list(self.windows.values()) + [0])
+      self.max_entries = max_entries
+      if self.ttl == 0:
+        self.entries.clear()
+
+  def _expire(self, now):
+    while len(self.entries) > 0:
+      (key, entry) = next(iter(self.entries.items()))
+      expired = now - entry[0] >= self.ttl
+      if not expired and len(self.entries) <= self.max_entries:
+        return
+      self.entries.popitem(last=False)
+      if not expired:
+        self.evicted += 1
+
+  # Returns, for each of the destinations, the messages that were not notified there during
+  # the window of its channel
+  def filter(self, msgs, destinations, now=None):
+    result = { destination: [] for destination in destinations }
+    if self.ttl == 0:
+      for destination in destinations:
+        result[destination] = list(msgs)
+      return result
+    if now is None:
+      now = time.time()
+    with self.lock:
+      for msg in msgs:
+        key = msg.key()
+        entry = self.entries.get(key)
+        if entry is None:
+          entry = [now, {}]
+          self.entries[key] = entry
+        else:
+          entry[0] = now
+          self.entries.move_to_end(key)
+        for destination in destinations:
+          channel = destination[0]
+          window = self.windows.get(channel, 0)
+          last = entry[1].get(destination)
+          if window > 0 and last is not None and now - last < window:
+            self.suppressed[channel] = self.suppressed.get(channel, 0) + 1
+          else:
+            entry[1][destination] = now
+            result[destination].append(msg)
+      self._expire(now)
+    return result
+
+  # Forget that the reports of the keys were notified to the destination, as sending them
+  # failed: they are notified again the next time they are read
+  def forget(self, keys, destination):
+    with self.lock:
+      for key in keys:
+        entry = self.entries.get(key)
+        if entry is not None:
+          entry[1].pop(destination, None)
+
+  def stats(self):
+    with self.lock:
+      return { "size": len(self.entries), "evicted": self.evicted, "suppressed": dict(self.suppressed) }
@@ -0,0 +1,94 @@
+import threading, queue, time, logging, metrics
+
+_STOP = object()
+
+# Sends the notifications of one channel from its own pool of threads, so that
+# a slow channel blocks neither the reading of the log nor the other channels.
+# The queue is bounded: when a channel cannot keep up, submit() blocks, slowing
+# down the log follower instead of buffering without limit.
+class channelDispatcher:
+  def __init__(self, name, handler, workers=1, queue_size=100):
+    self.name = name
+    self.handler = handler
+    self.queue = queue.Queue(queue_size)
+    self.lock = threading.Lock()
+    self.sent = 0
+    self.failed = 0
+    self.blocked = 0
+    self.max_depth = 0
+    self.latency_sum = 0.0
+    self.latency_max = 0.0
+    self.latency = metrics.histogram()
+    self.threads = []
+    for i in range(max(1, workers)):
+      thread = threading.Thread(target=self._work, name="notify-" + name + "-" + str(i))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, *args):
+    try:
+      self.queue.put_nowait(args)
+    except queue.Full:
+      with self.lock:
+        self.blocked += 1
+      logging.warning("The " + self.name + " notification queue is full, waiting for it")
+      self.queue.put(args)
+    depth = self.queue.qsize()
+    if depth > self.max_depth:
+      self.max_depth = depth
+
+  def depth(self):
+    return self.queue.qsize()
+
+  def _work(self):
+    while True:
+      args = self.queue.get()
+      if args is _STOP:
+        self.queue.task_done()
+        return
+      start = time.time()
+      failed = False
+      try:
+        self.handler(*args)
+      except Exception as e:
+        failed = True
+        logging.error("Could not send the " + self.name + " notification: " + str(e))
+      latency = time.time() - start
+      self.latency.observe(latency)
+      with self.lock:
+        if failed:
+          self.failed += 1
+        else:
+          self.sent += 1
+        self.latency_sum += latency
+        if latency > self.latency_max:
+          self.latency_max = latency
+      self.queue.task_done()
+
+  # Send what is already queued (waiting at most timeout seconds) and stop the threads
+  def stop(self, timeout=10):
+    deadline = time.time() + timeout
+    for thread in self.threads:
+      try:
+        self.queue.put(_STOP, timeout=max(0, deadline - time.time()))
+      except queue.Full:
+        # the threads are stuck on a hung channel, they are daemons and do not block the exit
+        break
+    for thread in self.threads:
+      thread.join(max(0, deadline - time.time()))
+    if self.queue.qsize() > 0:
+      logging.warning(str(self.queue.qsize()) + " " + self.name + " notifications were not sent before stopping")
+
+  def stats(self):
+    with self.lock:
+      done = self.sent + self.failed
+      return {
+        "queue_depth": self.queue.qsize(),
+        "queue_max_depth": self.max_depth,
+        "blocked": self.blocked,
+        "sent": self.sent,
+        "failed": self.failed,
+        "latency_avg": self.latency_sum / done if done > 0 else 0.0,
+        "latency_max": self.latency_max
+      }
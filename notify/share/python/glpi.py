@@ -1,33 +1,263 @@
-import requests, json
+import requests, json, random, time, threading, hashlib, html, re, functools, logging
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urlencode, quote_plus
+
+# HTTP codes worth retrying
+RETRIED_CODES = frozenset(['429', '500', '502', '503', '504'])
+
+class glpiError(Exception):
+  pass
 
 # TODO clean initializing to create the adequate ticket
 
+# Links, fields and search types are a handful of values, their encoding is cached
+encodeKeyword = functools.lru_cache(maxsize=256)(quote_plus)
+
 # Class used to create the php filter to look for objects in the glpi api
+# Besides the criteria, it holds the fields to display (forcedisplay) and the range
+# of results to return.
+# The query string is URL encoded, and kept until the criterias are modified.
 class criterias:
   def __init__(self):
     self.array = []
+    self.forcedisplay = []
+    self.range = None
+    self.query = None
 
   def addCriteria(self, criteria):
     self.array.append(criteria)
+    self.query = None
+
+  # Only return these fields (the id is always returned)
+  def display(self, fields):
+    self.forcedisplay = list(fields)
+    self.query = None
+
+  def setRange(self, start, end):
+    self.range = (start, end)
+    self.query = None
 
   def __str__(self):
-    output = ""
-    for iCriteria in range(len(self.array)):
-      output += (self.array[iCriteria]).show(iCriteria) + "&"
-    return output[:len(output)-1]
-      
+    if self.query is None:
+      parts = [ self.array[iCriteria].show(iCriteria) for iCriteria in range(len(self.array)) ]
+      params = [ ("forcedisplay[" + str(iField) + "]", field) for (iField, field) in enumerate(self.forcedisplay) ]
+      if self.range is not None:
+        params.append(("range", str(self.range[0]) + "-" + str(self.range[1])))
+      if len(params) > 0:
+        parts.append(urlencode(params))
+      self.query = "&".join(parts)
+    return self.query
+
+# A criteria should not be modified once built: its encoded form is cached for each
+# position it is used at, so that it can be reused in several searches at no cost.
+# parent is the URL encoded name of the list holding the criteria.
 class criteria:
   def __init__(self, field, searchType, value, link="AND"):
     self.link = link
     self.field = field
     self.searchtype = searchType
     self.value = value
+    self.encoded = {}
 
-  def show(self, i):
-    sep = "criteria[" + str(i) + "]"
-    return sep + "[link]=" + self.link + "&" + sep + "[field]=" + self.field + "&" + sep + "[searchtype]=" + self.searchtype + "&" + sep + "[value]=" + self.value
-    
+  def show(self, i, parent="criteria"):
+    sep = parent + "%5B" + str(i) + "%5D"
+    if sep not in self.encoded:
+      self.encoded[sep] = "&".join([ sep + "%5Blink%5D=" + encodeKeyword(self.link), sep + "%5Bfield%5D=" + encodeKeyword(self.field),
+                                     sep + "%5Bsearchtype%5D=" + encodeKeyword(self.searchtype), sep + "%5Bvalue%5D=" + quote_plus(self.value) ])
+    return self.encoded[sep]
+
+# A group of criteria, evaluated together (like parentheses), linked to the previous
+# criteria with `link`. Criteria inside the group can be linked with OR.
+class criteriaGroup:
+  def __init__(self, criteriaList, link="AND"):
+    self.link = link
+    self.array = criteriaList
+    self.encoded = {}
+
+  def show(self, i, parent="criteria"):
+    sep = parent + "%5B" + str(i) + "%5D"
+    if sep not in self.encoded:
+      parts = [ sep + "%5Blink%5D=" + encodeKeyword(self.link) ]
+      parts.extend(self.array[iCriteria].show(iCriteria, sep + "%5Bcriteria%5D") for iCriteria in range(len(self.array)))
+      self.encoded[sep] = "&".join(parts)
+    return self.encoded[sep]
+
+
+# Key of a ticket in the local index, from its name and the part of its content
+# identifying the report regardless of its date
+def ticketKey(name, content):
+  return hashlib.sha1((name + "\0" + content).encode('utf-8')).digest()
+
+NODE_UUID_REGEX = re.compile(r"Node UUID: ([^\s<&]+)")
+
+# Local index of the open tickets created by Rudder, so that checking if a similar ticket
+# exists does not need to search GLPI for every report.
+# It is loaded with a single (paginated) search, updated when tickets are created, and
+# reloaded every `refresh` seconds to forget the tickets solved or closed in GLPI.
+# A report missing from the index is still looked for in GLPI before opening a ticket.
+class ticketIndex:
+  def __init__(self, session, prefix, refresh=3600):
+    self.session = session
+    self.prefix = prefix
+    self.refresh = refresh
+    self.lock = threading.Lock()
+    self.keys = {}
+    self.loaded = 0
+    self.hits = 0
+    self.misses = 0
 
+  def load(self):
+    keys = {}
+    for row in self.session.searchOpenTickets(self.prefix):
+      name = html.unescape(str(row.get(self.session.field['name'], '')))
+      match = NODE_UUID_REGEX.search(html.unescape(str(row.get(self.session.field['content'], ''))))
+      if match is not None:
+        keys[ticketKey(name, " - Node UUID: " + match.group(1))] = row.get(self.session.field['id'])
+    with self.lock:
+      self.keys = keys
+      self.loaded = time.time()
+    logging.info("Loaded " + str(len(keys)) + " open GLPI tickets in the local index")
+
+  def reloadIfExpired(self):
+    if time.time() - self.loaded >= self.refresh:
+      try:
+        self.load()
+      except (glpiError, requests.RequestException, ValueError) as e:
+        logging.error("Could not reload the GLPI tickets index, keeping the current one: " + str(e))
+
+  # Returns the id of the open ticket matching name and content, None if there is none
+  def find(self, name, content):
+    with self.lock:
+      ticketId = self.keys.get(ticketKey(name, content))
+      if ticketId is not None:
+        self.hits += 1
+      else:
+        self.misses += 1
+      return ticketId
+
+  def add(self, name, content, ticketId):
+    with self.lock:
+      self.keys[ticketKey(name, content)] = ticketId
+
+  def stats(self):
+    with self.lock:
+      return { "size": len(self.keys), "hits": self.hits, "misses": self.misses }
+
+# Records on the open tickets that their non-compliance happened again, either as a
+# followup ("followup" mode) or by increasing a counter field of the ticket ("counter" mode).
+# Occurrences are coalesced and recorded every `interval` seconds, with a single bulk
+# call for all the tickets. Counters are read from GLPI the first time a ticket recurs.
+# The occurrences which could not be recorded are kept and recorded with the next ones.
+class recurrenceRecorder:
+  def __init__(self, getSession, mode, counterField=None, interval=300):
+    self.getSession = getSession
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.counters = {}
+    self.generation = 0
+    self.recorded = 0
+    self.failed = 0
+    self.configure(mode, counterField, interval)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, name="notify-glpi-recurrences")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def configure(self, mode, counterField, interval):
+    self.mode = mode
+    self.counterField = counterField
+    self.interval = interval
+
+  # Forget everything, when the GLPI server changed
+  def clear(self):
+    with self.lock:
+      self.pending = {}
+      self.counters = {}
+      self.generation += 1
+
+  def add(self, ticketId, date, content):
+    with self.lock:
+      if ticketId in self.pending:
+        occurrence = self.pending[ticketId]
+        occurrence[0] += 1
+        occurrence[2] = date
+        occurrence[3] = content
+      else:
+        self.pending[ticketId] = [1, date, date, content]
+
+  # Put back the occurrences which could not be recorded, before the ones added since
+  def requeue(self, occurrences, generation):
+    with self.lock:
+      # the tickets are from another GLPI server
+      if generation != self.generation:
+        return
+      for (ticketId, occurrence) in occurrences.items():
+        if ticketId in self.pending:
+          newer = self.pending[ticketId]
+          newer[0] += occurrence[0]
+          newer[1] = occurrence[1]
+        else:
+          self.pending[ticketId] = occurrence
+
+  def stats(self):
+    with self.lock:
+      return { "pending": len(self.pending), "recorded": self.recorded, "failed": self.failed }
+
+  def flush(self):
+    session = self.getSession()
+    if session is None:
+      return
+    with self.lock:
+      pending = self.pending
+      generation = self.generation
+      self.pending = {}
+    if len(pending) == 0:
+      return
+    ticketIds = list(pending)
+    unrecorded = pending
+    try:
+      if self.mode == "followup":
+        followups = []
+        for ticketId in ticketIds:
+          (count, first, last, content) = pending[ticketId]
+          when = " on " + last if first == last else " between " + first + " and " + last
+          followups.append((ticketId, "This non-compliance happened " + str(count) + " more time" + ("s" if count > 1 else "") +
+                                      when + ", last report:\n" + content))
+        results = session.addFollowups(followups)
+      elif self.mode == "counter":
+        updates = []
+        for ticketId in ticketIds:
+          if ticketId not in self.counters:
+            current = session.getTicket(str(ticketId)).get(self.counterField)
+            self.counters[ticketId] = int(current) if current else 0
+          updates.append({ "id": ticketId, self.counterField: self.counters[ticketId] + pending[ticketId][0] })
+        results = session.updateTickets(updates)
+        # the counters only include the recorded occurrences
+        for (update, recorded) in zip(updates, results):
+          if recorded:
+            self.counters[update["id"]] = update[self.counterField]
+      else:
+        results = [ True ] * len(ticketIds)
+      unrecorded = { ticketId: pending[ticketId] for (ticketId, recorded) in zip(ticketIds, results) if not recorded }
+      if len(unrecorded) > 0:
+        logging.error("Could not record the recurrences of " + str(len(unrecorded)) + " GLPI tickets, will retry")
+    except (glpiError, requests.RequestException, ValueError) as e:
+      logging.error("Could not record the recurrences of " + str(len(pending)) + " GLPI tickets, will retry: " + str(e))
+    self.recorded += len(pending) - len(unrecorded)
+    self.failed += len(unrecorded)
+    if len(unrecorded) > 0:
+      self.requeue(unrecorded, generation)
+
+  def _run(self):
+    while not self.stopped.wait(max(self.interval, 1)):
+      self.flush()
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.flush()
 
 # Class used to create a ticket in the glpi api
 class glpiTicket:
@@ -48,20 +278,34 @@ class glpiTicket:
     return { key:value for key, value in self.__dict__.items() if not key.startswith('__') and not callable(key) }
 
 # Class used to create and parse the api queries
+# All the queries go through a pooled keep-alive HTTP session. An expired session token
+# is renewed transparently, transient errors are retried with an exponential backoff,
+# and other errors raise a glpiError.
 class glpiSession:
-  def __init__(self, userToken, apiToken, baseUrl):
+  def __init__(self, userToken, apiToken, baseUrl, timeout=30, retries=3, backoff=1.0, poolSize=4):
     self.userToken = userToken
     self.apiToken  = apiToken
     self.baseUrl   = baseUrl
     self.headers   = ''
     self.sessionToken = ''
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.lock = threading.Lock()
+    self.statusGroups = {}
+    self.http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+    self.http.mount("https://", adapter)
+    self.http.mount("http://", adapter)
     self.field = {
+           "id": "2",
       "content": "21",
        "status": "12",
          "name": "1",
          "type": "14"
       }
     self.status = {
+        "notold": "notold",
       "assigned": "2",
        "planned": "3",
        "pending": "4",
@@ -72,32 +316,191 @@ class glpiSession:
 
   def initSession(self):
     headers = { 'Content-Type': 'application/json', 'Authorization': "user_token "+self.userToken, 'App-Token': self.apiToken }
-    response = requests.get(self.baseUrl + '/initSession', headers=headers)
+    response = self.send('GET', '/initSession', headers)
     if (self.controlCode(['200'], response)):
       self.sessionToken = response.json()['session_token']
       self.headers = { 'Content-Type': 'application/json', 'Session-Token': self.sessionToken, 'App-Token': self.apiToken }
 
   def killSession(self):
-    response = requests.get(self.baseUrl + '/killSession', headers=self.headers)
-    exit()
+    try:
+      self.http.get(self.baseUrl + '/killSession', headers=self.headers, timeout=self.timeout)
+    except requests.RequestException:
+      pass
+    self.sessionToken = ''
+    self.http.close()
+
+  # Send a request, retrying connection errors and transient HTTP errors
+  def send(self, method, url, headers, data=None):
+    for attempt in range(self.retries + 1):
+      try:
+        response = self.http.request(method, self.baseUrl + url, headers=headers, data=data, timeout=self.timeout)
+        if str(response.status_code) not in RETRIED_CODES:
+          return response
+        error = "HTTP " + str(response.status_code)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        error = str(e)
+      if attempt < self.retries:
+        delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+        logging.warning("GLPI API call failed (" + error + "), retrying in " + str(round(delay, 1)) + "s")
+        time.sleep(delay)
+    raise glpiError("GLPI API call to " + url + " failed after " + str(self.retries + 1) + " attempts: " + error)
+
+  # Send an authenticated request, opening a new session if there is none or if it expired
+  def request(self, method, url, data=None):
+    with self.lock:
+      if self.sessionToken == '':
+        self.initSession()
+      headers = self.headers
+    response = self.send(method, url, headers, data)
+    if response.status_code == 401 and 'ERROR_SESSION_TOKEN_INVALID' in response.text:
+      logging.info("GLPI session expired, opening a new one")
+      with self.lock:
+        if self.headers is headers:
+          self.initSession()
+        headers = self.headers
+      response = self.send(method, url, headers, data)
+    return response
 
   def openTicket(self, name, description):
     data = { "input": glpiTicket(name, description).build() }
-    response = requests.post(self.baseUrl + '/Ticket' , headers=self.headers, data=json.dumps(data))
+    response = self.request('POST', '/Ticket', json.dumps(data))
     if (self.controlCode(['201'], response)):
       return 0
 
+  # Send items by chunks of chunkSize to an endpoint accepting a list under 'input',
+  # returns the answer of GLPI for each item, in the same order
+  def bulk(self, method, url, items, chunkSize=50):
+    results = []
+    for start in range(0, len(items), chunkSize):
+      chunk = items[start:start + chunkSize]
+      response = self.request(method, url, json.dumps({ "input": chunk }))
+      try:
+        answer = response.json()
+      except ValueError:
+        answer = None
+      if isinstance(answer, list) and len(answer) == 2 and isinstance(answer[0], str) and isinstance(answer[1], list):
+        # When some items could not be processed, the per-item answers come with an error:
+        # [ "ERROR_GLPI_PARTIAL_ADD", [ ... ] ] (207), or "ERROR_GLPI_ADD" (400) when none was
+        self.controlCode(['207', '400'], response)
+        logging.warning("GLPI could not process some of the items sent to " + url + ": " + answer[0])
+        answer = answer[1]
+      else:
+        self.controlCode(['200', '201'], response)
+      if isinstance(answer, dict):
+        answer = [ answer ]
+      if not isinstance(answer, list) or len(answer) != len(chunk):
+        raise glpiError("Unexpected answer from the GLPI API for " + str(len(chunk)) + " items sent to " + url + ": " + response.text)
+      results.extend(answer)
+    return results
+
+  # Was an item of a bulk request processed: its answer is { "id": id or false, "message": "" }
+  # for a creation, { "<id>": true or false, "message": "" } for an update
+  @staticmethod
+  def bulkItemSucceeded(answer):
+    if not isinstance(answer, dict):
+      return False
+    values = [ value for (key, value) in answer.items() if key != 'message' ]
+    return len(values) > 0 and all(value is not None and value is not False for value in values)
+
+  # Open several tickets at once. tickets is a list of (name, description), returns the
+  # list of the created ticket ids, in the same order, with None for the tickets GLPI
+  # could not create.
+  def openTickets(self, tickets, chunkSize=50):
+    results = self.bulk('POST', '/Ticket', [ glpiTicket(name, description).build() for (name, description) in tickets ], chunkSize)
+    ids = []
+    for (iTicket, result) in enumerate(results):
+      if self.bulkItemSucceeded(result) and 'id' in result:
+        ids.append(result['id'])
+      else:
+        message = result.get('message', '') if isinstance(result, dict) else str(result)
+        logging.error("GLPI could not create ticket " + tickets[iTicket][0] + ": " + str(message))
+        ids.append(None)
+    return ids
+
+  # Add followups to tickets, followups is a list of (ticket id, content).
+  # Returns, in the same order, whether each followup was added.
+  def addFollowups(self, followups, chunkSize=50):
+    items = [ { "itemtype": "Ticket", "items_id": ticketId, "content": content } for (ticketId, content) in followups ]
+    return [ self.bulkItemSucceeded(result) for result in self.bulk('POST', '/ITILFollowup', items, chunkSize) ]
+
+  # Update fields of tickets, updates is a list of dicts holding the ticket 'id' and the new values.
+  # Returns, in the same order, whether each ticket was updated.
+  def updateTickets(self, updates, chunkSize=50):
+    return [ self.bulkItemSucceeded(result) for result in self.bulk('PUT', '/Ticket', updates, chunkSize) ]
+
   def getTickets(self):
-    response = requests.get(self.baseUrl + '/Ticket' , headers=self.headers)
-    if (self.controlCode(['200'], response)):
+    response = self.request('GET', '/Ticket')
+    if (self.controlCode(['200', '206'], response)):
       return response.json()
 
+  # Walk the pages returned by fetch(start, end) -> (items, total), yielding the items.
+  # When prefetch > 0, up to prefetch next pages are downloaded in parallel while the
+  # current one is consumed, only these pages are kept in memory.
+  def pages(self, fetch, pageSize, prefetch=0):
+    (items, total) = fetch(0, pageSize - 1)
+    for item in items:
+      yield item
+    if total is None:
+      # No total known, go on until a page is not full
+      start = pageSize
+      while len(items) == pageSize:
+        (items, total) = fetch(start, start + pageSize - 1)
+        for item in items:
+          yield item
+        start += pageSize
+      return
+    starts = range(pageSize, total, pageSize)
+    if prefetch <= 0:
+      for start in starts:
+        for item in fetch(start, start + pageSize - 1)[0]:
+          yield item
+      return
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+      pending = deque()
+      nextStarts = iter(starts)
+      for start in nextStarts:
+        pending.append(executor.submit(fetch, start, start + pageSize - 1))
+        if len(pending) >= prefetch:
+          break
+      while len(pending) > 0:
+        items = pending.popleft().result()[0]
+        start = next(nextStarts, None)
+        if start is not None:
+          pending.append(executor.submit(fetch, start, start + pageSize - 1))
+        for item in items:
+          yield item
+
+  def fetchTicketsPage(self, start, end):
+    response = self.request('GET', '/Ticket?range=' + str(start) + '-' + str(end))
+    if response.status_code == 400 and 'ERROR_RANGE_EXCEED_TOTAL' in response.text:
+      return ([], 0)
+    self.controlCode(['200', '206'], response)
+    total = None
+    contentRange = response.headers.get('Content-Range')
+    if contentRange is not None and '/' in contentRange:
+      total = int(contentRange.split('/')[1])
+    return (response.json(), total)
+
+  # Iterate over all the tickets, fetched by pages of pageSize tickets
+  def iterTickets(self, pageSize=100, prefetch=0):
+    return self.pages(self.fetchTicketsPage, pageSize, prefetch)
+
   def getTicket(self, ticketID):
-    response = requests.get(self.baseUrl + '/Ticket/' + ticketID , headers=self.headers)
+    response = self.request('GET', '/Ticket/' + ticketID)
     if (self.controlCode(['200'], response)):
       return response.json()
 
-  def searchTicket(self, name, content=None, ticket_status=None):
+  # The same status groups are used for every search, they are only built once
+  def statusGroup(self, statuses):
+    key = tuple(statuses)
+    if key not in self.statusGroups:
+      statusCriteria = [ criteria(self.field['status'], "equals", self.status[iStatus], link="OR") for iStatus in statuses ]
+      self.statusGroups[key] = criteriaGroup(statusCriteria, link="AND")
+    return self.statusGroups[key]
+
+  # ticket_status can be a single status or a list of statuses, which are all
+  # looked for at once. fields and ticketRange limit the returned data.
+  def searchTicket(self, name, content=None, ticket_status=None, fields=None, ticketRange=None):
     filters = criterias()
     # Filter on Name
     nameCriteria = criteria(self.field['name'], "contains", name, link="AND")
@@ -107,28 +510,41 @@ class glpiSession:
       contentCriteria = criteria(self.field['content'], "contains", content, link="AND")
       filters.addCriteria(contentCriteria)
     # Filter on ticket_status
-    if (ticket_status != None):
+    if isinstance(ticket_status, list):
+      filters.addCriteria(self.statusGroup(ticket_status))
+    elif (ticket_status != None):
       statusCriteria = criteria(self.field['status'], "equals", self.status[ticket_status], link="AND")
       filters.addCriteria(statusCriteria)
+    if (fields != None):
+      filters.display([ self.field[iField] for iField in fields ])
+    if (ticketRange != None):
+      filters.setRange(ticketRange[0], ticketRange[1])
 
-    response = requests.get(self.baseUrl + '/search/Ticket?' + str(filters), headers=self.headers)
-    if (self.controlCode(['200'], response)):
+    response = self.request('GET', '/search/Ticket?' + str(filters))
+    # 206 is returned when there are more results than the returned range
+    if (self.controlCode(['200', '206'], response)):
       return response.json()
 
+  # Iterate over the tickets neither solved nor closed whose name contains `name`,
+  # with only their id, name and content
+  def searchOpenTickets(self, name, pageSize=500, prefetch=0):
+    def fetch(start, end):
+      result = self.searchTicket(name, None, 'notold', ['id', 'name', 'content'], (start, end))
+      return (result.get('data', []), result.get('totalcount', 0))
+    return self.pages(fetch, pageSize, prefetch)
+
+  # A single search for all the statuses, returning the id of the first matching ticket, or None
+  def findSimilarTicket(self, ticket, ticket_status=None):
+    result = self.searchTicket(ticket.name, ticket.content, ticket_status, ['id'], (0, 0))
+    if result['totalcount'] >= 1 and len(result.get('data', [])) > 0:
+      return result['data'][0].get(self.field['id'])
+    return None
+
   def similarTicketExists(self, ticket, ticket_status=None):
-    if (ticket_status != None):
-      for iStatus in ticket_status:
-        if (self.searchTicket(ticket.name, ticket.content, iStatus)['totalcount'] >= 1):
-          return True
-      return False
-    else:
-      if (self.searchTicket(ticket.name, ticket.content, ticket_status)['totalcount'] >= 1):
-        return True
-      else:
-        return False
+    return self.searchTicket(ticket.name, ticket.content, ticket_status, ['id'], (0, 0))['totalcount'] >= 1
 
   def customGETRequest(self, url):
-    response = requests.get(self.baseUrl + url , headers=self.headers)
+    response = self.request('GET', url)
     if (self.controlCode(['200'], response)):
       return (response.text.encode('utf-8'))
     
@@ -136,8 +552,5 @@ class glpiSession:
     if (str(response.status_code) in expectedCodes):
       return True
     else:
-      print(response.text.encode('utf-8'))
-      print("Something went wrong while calling the GLPI API, received error code " + str(response.status_code))
-      self.killSession()
-      return False
+      raise glpiError("Something went wrong while calling the GLPI API, received error code " + str(response.status_code) + ": " + response.text)
 
@@ -1,9 +1,297 @@
-import os, time, subprocess
+import os, time, select, errno, ctypes, ctypes.util, json, hashlib, logging
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Number of bytes before the checkpoint offset whose digest is saved with it
+CHECKPOINT_DIGEST_BYTES = 4096
+
+# Minimal ctypes binding to the linux inotify API.
+# We watch the directory containing the log file rather than the file itself,
+# so that rotations (move + create) and deletions are also notified.
+class inotifyWatcher:
+  def __init__(self, path):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, "inotify_add_watch failed on " + path)
+    self.poller = select.poll()
+    self.poller.register(self.fd, select.POLLIN)
+
+  # Block until something happens in the watched directory, or timeout (in seconds) expires
+  def wait(self, timeout):
+    if self.poller.poll(timeout * 1000):
+      # We do not care about individual events, the follower re-checks the file anyway
+      try:
+        while os.read(self.fd, 4096):
+          pass
+      except OSError as e:
+        if e.errno != errno.EAGAIN:
+          raise
+      return True
+    return False
+
+  def close(self):
+    os.close(self.fd)
+
+# Fallback used when inotify is not available
+class pollWatcher:
+  def wait(self, timeout):
+    time.sleep(timeout)
+    return False
+
+  def close(self):
+    pass
+
+
+# Follows a log file like "tail -F" would, but in-process:
+#  - the file is read by large blocks and every complete line is yielded immediately
+#  - it sleeps on inotify events (or polls every poll_interval seconds if inotify is unavailable)
+#  - rotation (inode change) and truncation are detected and followed
+#  - lines_per_second and lag_bytes can be read to monitor the follower
+# When a checkpoint file is given, the (inode, offset) of the last consumed line is saved
+# every checkpoint_interval seconds and on close, and the follower resumes from it on start.
+# A digest of the bytes preceding the offset is saved too: when they changed (the file was
+# truncated and rewritten in place, e.g. by a copytruncate rotation), the file is read again
+# from its beginning rather than from the middle of a line.
+# The backlog to catch up is bounded to max_catchup_bytes, older data is skipped.
+# on_idle is called, if set, every time the follower waits for new lines.
+class LogFollower:
+  def __init__(self, filename, block_size=65536, poll_interval=1.0, from_end=True, max_batch=10000,
+               checkpoint_file=None, checkpoint_interval=10, max_catchup_bytes=None, on_idle=None):
+    self.filename = filename
+    self.checkpoint_file = checkpoint_file
+    self.checkpoint_interval = checkpoint_interval
+    self.max_catchup_bytes = max_catchup_bytes
+    self.block_size = block_size
+    self.max_batch = max_batch
+    self.poll_interval = poll_interval
+    self.on_idle = on_idle
+    self.from_end = from_end
+    self.fd = None
+    self.inode = None
+    self.offset = 0          # offset of the first byte not yet returned as a complete line
+    self.partial = b''       # incomplete trailing line
+    self.committed = None    # (inode, offset) of the last line processed by the caller
+    self.saved = None
+    self.last_checkpoint = time.time()
+    self.catchup_end = 0     # the backlog found on start ends at this offset
+    self.catching_up = False # is the last yielded batch part of this backlog
+    self.lines_read = 0
+    self.lines_per_second = 0.0
+    self._rate_lines = 0
+    self._rate_start = time.time()
+    self.watcher = None
+
+  def _watch(self):
+    try:
+      self.watcher = inotifyWatcher(os.path.dirname(os.path.abspath(self.filename)))
+    except (OSError, AttributeError) as e:
+      logging.warning("inotify unavailable (" + str(e) + "), polling " + self.filename + " every " + str(self.poll_interval) + "s")
+      self.watcher = pollWatcher()
+
+  def _open(self, seek_end):
+    try:
+      fd = os.open(self.filename, os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
+      return False
+    st = os.fstat(fd)
+    self.fd = fd
+    self.inode = st.st_ino
+    self.offset = st.st_size if seek_end else 0
+    self.partial = b''
+    os.lseek(fd, self.offset, os.SEEK_SET)
+    return True
+
+  def _load_checkpoint(self):
+    try:
+      with open(self.checkpoint_file) as fd:
+        data = json.load(fd)
+      digest = data.get("digest")
+      return (int(data["inode"]), int(data["offset"]), None if digest is None else str(digest))
+    except FileNotFoundError:
+      return None
+    except (ValueError, KeyError, TypeError) as e:
+      logging.warning("Ignoring invalid checkpoint file " + self.checkpoint_file + ": " + str(e))
+      return None
+
+  # Digest of the CHECKPOINT_DIGEST_BYTES bytes of the open file preceding offset
+  def _digest(self, offset):
+    start = max(0, offset - CHECKPOINT_DIGEST_BYTES)
+    return hashlib.sha1(os.pread(self.fd, offset - start, start)).hexdigest()
+
+  # Does the open file still contain the data read before the checkpoint
+  def _checkpoint_valid(self, checkpoint, size):
+    (inode, offset, digest) = checkpoint
+    if inode != self.inode or offset > size:
+      return False
+    if digest is not None:
+      return self._digest(offset) == digest
+    # checkpoint without digest: it is at least at the beginning of a line
+    return offset == 0 or os.pread(self.fd, 1, offset - 1) == b'\n'
+
+  # Open the file at the checkpoint offset if there is one, else at its end (or beginning)
+  def _resume(self):
+    checkpoint = self._load_checkpoint() if self.checkpoint_file is not None else None
+    if not self._open(self.from_end and checkpoint is None):
+      return
+    size = os.fstat(self.fd).st_size
+    if checkpoint is not None:
+      if self._checkpoint_valid(checkpoint, size):
+        self.offset = checkpoint[1]
+      else:
+        # The file was rotated, truncated or rewritten while we were stopped, read the new one from its start
+        self.offset = 0
+      if self.max_catchup_bytes is not None and size - self.offset > self.max_catchup_bytes:
+        skipped = size - self.max_catchup_bytes - self.offset
+        self.offset = size - self.max_catchup_bytes
+        logging.warning("Backlog of " + self.filename + " is too large, skipping its first " + str(skipped) + " bytes")
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        # Resume at the beginning of the next complete line
+        self.partial = os.read(self.fd, self.block_size)
+        newline = self.partial.find(b'\n')
+        while newline < 0 and len(self.partial) < size - self.offset:
+          self.partial += os.read(self.fd, self.block_size)
+          newline = self.partial.find(b'\n')
+        self.offset += newline + 1 if newline >= 0 else len(self.partial)
+        self.partial = b''
+      os.lseek(self.fd, self.offset, os.SEEK_SET)
+      if self.offset < size:
+        logging.info("Resuming " + self.filename + " at offset " + str(self.offset) + ", " + str(size - self.offset) + " bytes to catch up")
+    self.catchup_end = size
+    self.committed = (self.inode, self.offset)
+
+  def checkpoint(self):
+    if self.checkpoint_file is None or self.committed is None or self.committed == self.saved:
+      return
+    (inode, offset) = self.committed
+    data = { "inode": inode, "offset": offset }
+    tmp = self.checkpoint_file + ".tmp"
+    try:
+      if self.fd is not None and inode == self.inode:
+        data["digest"] = self._digest(offset)
+      os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_file)), exist_ok=True)
+      with open(tmp, 'w') as fd:
+        json.dump(data, fd)
+      os.rename(tmp, self.checkpoint_file)
+      self.saved = self.committed
+    except OSError as e:
+      logging.error("Could not save checkpoint to " + self.checkpoint_file + ": " + str(e))
+    self.last_checkpoint = time.time()
+
+  def _close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  # Read the available data (up to max_batch lines) and return the complete lines
+  def _read_available(self):
+    lines = []
+    while len(lines) < self.max_batch:
+      block = os.read(self.fd, self.block_size)
+      if not block:
+        break
+      chunks = (self.partial + block).split(b'\n')
+      self.partial = chunks.pop()
+      for chunk in chunks:
+        self.offset += len(chunk) + 1
+        if chunk:
+          lines.append(chunk.decode('utf-8', 'replace').strip())
+    return lines
+
+  # Detect rotation and truncation of the followed file, returns True if the file was (re)opened
+  def _check_file(self):
+    try:
+      st = os.stat(self.filename)
+    except FileNotFoundError:
+      return False
+    if self.fd is None or st.st_ino != self.inode:
+      # The old file has been fully read by the caller, switch to the new one from its beginning
+      logging.info("Following new file " + self.filename)
+      self._close()
+      if self._open(False):
+        self.committed = (self.inode, self.offset)
+        return True
+      return False
+    if st.st_size < self.offset + len(self.partial):
+      logging.info("File " + self.filename + " was truncated, reading it from the beginning")
+      self.offset = 0
+      self.partial = b''
+      os.lseek(self.fd, 0, os.SEEK_SET)
+      return True
+    return False
+
+  def _count(self, n):
+    self.lines_read += n
+    self._rate_lines += n
+    now = time.time()
+    elapsed = now - self._rate_start
+    if elapsed >= 1.0:
+      self.lines_per_second = self._rate_lines / elapsed
+      self._rate_lines = 0
+      self._rate_start = now
+
+  # Number of bytes written to the file that were not consumed yet
+  def lag_bytes(self):
+    try:
+      return max(0, os.stat(self.filename).st_size - self.offset)
+    except FileNotFoundError:
+      return 0
+
+  # Yields lists of all the lines available at once, blocks until there is something to read
+  def batches(self):
+    if self.watcher is None:
+      self._watch()
+    if self.fd is None:
+      self._resume()
+    try:
+      while True:
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+          self.checkpoint()
+        self.catching_up = self.fd is not None and self.offset < self.catchup_end
+        lines = self._read_available() if self.fd is not None else []
+        if not lines:
+          if self._check_file():
+            continue
+          self._count(0)
+          if self.on_idle is not None:
+            self.on_idle()
+          self.watcher.wait(self.poll_interval)
+          continue
+        self._count(len(lines))
+        position = (self.inode, self.offset)
+        yield lines
+        # the caller asks for more lines, the previous ones are processed
+        self.committed = position
+    finally:
+      self.close()
+
+  def lines(self):
+    for batch in self.batches():
+      for line in batch:
+        yield line
+
+  def close(self):
+    self.checkpoint()
+    self._close()
+    if self.watcher is not None:
+      self.watcher.close()
+      self.watcher = None
+
 
 def log_tail(filename):
-    sp = subprocess.Popen(["tail", "-F", "-n 0", filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    while True:
-        line = sp.stdout.readline().decode('utf-8')
-        if line:
-            yield line.strip()
-        time.sleep(1)
+  return LogFollower(filename).lines()
@@ -0,0 +1,139 @@
+import smtplib, socket, threading, time, logging, metrics
+from email.message import EmailMessage
+
+MAIL_SUBJECT = "Rudder non-compliance notification"
+# Seconds between two attempts to send the reports kept after a failure, when they are not batched
+MAIL_RETRY_PERIOD = 60
+
+# Sends the reports by e-mail, in batches:
+#  - reports are kept in memory and sent every batch_period seconds by a timer thread
+#    (right away when batch_period is 0)
+#  - a batch is a single message, sent to all the recipients over a single SMTP connection
+#    to the configured relay
+#  - at most max_queue reports are detailed in a batch, the other ones are summarized
+#    by rule and directive at the end of the message
+#  - reports routed to other recipients than the configured ones are sent in their own
+#    message, over the same connection
+#  - when the relay cannot be reached, the messages not sent yet are put back in the queue
+#    (still bounded by max_queue) and sent again with the next batch, or after
+#    MAIL_RETRY_PERIOD seconds when batch_period is 0
+class mailBatcher:
+  def __init__(self, recipients, batch_period=0, smtp_host="localhost", smtp_port=25, sender=None, max_queue=1000, timeout=30):
+    self.lock = threading.Lock()
+    self.queue = []
+    self.overflow = {}
+    self.sent = 0
+    self.failed = 0
+    self.latency = metrics.histogram()
+    self.last = time.time()
+    self.configure(recipients, batch_period, smtp_host, smtp_port, sender, max_queue, timeout)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, name="notify-mail-batch")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def configure(self, recipients, batch_period, smtp_host, smtp_port, sender, max_queue, timeout):
+    self.recipients = recipients
+    self.batch_period = batch_period
+    self.smtp_host = smtp_host
+    self.smtp_port = smtp_port
+    self.sender = sender if sender else "rudder@" + socket.getfqdn()
+    self.max_queue = max_queue
+    self.timeout = timeout
+
+  # recipients is None for the configured recipients
+  def add(self, msgs, recipients=None):
+    with self.lock:
+      for msg in msgs:
+        if len(self.queue) < self.max_queue:
+          self.queue.append((recipients, msg))
+        else:
+          key = (recipients, msg.rule_name, msg.directive_name)
+          self.overflow[key] = self.overflow.get(key, 0) + 1
+    if self.batch_period == 0:
+      self.flush()
+
+  def pending(self):
+    with self.lock:
+      return len(self.queue) + sum(self.overflow.values())
+
+  def stats(self):
+    return { "pending": self.pending(), "sent": self.sent, "failed": self.failed }
+
+  # Put the (recipients, (msgs, overflow)) batches which could not be sent back in front of
+  # the queue, the reports beyond max_queue are summarized
+  def requeue(self, batches):
+    with self.lock:
+      queue = [ (recipients, msg) for (recipients, (msgs, overflow)) in batches for msg in msgs ] + self.queue
+      self.queue = queue[:self.max_queue]
+      for (recipients, msg) in queue[self.max_queue:]:
+        key = (recipients, msg.rule_name, msg.directive_name)
+        self.overflow[key] = self.overflow.get(key, 0) + 1
+      for (recipients, (msgs, overflow)) in batches:
+        for ((rule, directive), count) in overflow.items():
+          key = (recipients, rule, directive)
+          self.overflow[key] = self.overflow.get(key, 0) + count
+
+  def build(self, msgs, overflow, recipients):
+    total = len(msgs) + sum(overflow.values())
+    parts = [ str(total) + " notification" + ('s' if total > 1 else '') + " from Rudder :\n" ]
+    for i in range(len(msgs)):
+      parts.append("# " + str(i+1) + ' :\n' + str(msgs[i]) + '\n')
+    if len(overflow) > 0:
+      parts.append(str(sum(overflow.values())) + " more notifications were not detailed:\n")
+      for ((rule, directive), count) in sorted(overflow.items(), key=lambda item: -item[1]):
+        parts.append(" - Rule " + rule + " / Directive " + directive + ": " + str(count) + "\n")
+    mail = EmailMessage()
+    mail["Subject"] = MAIL_SUBJECT
+    mail["From"] = self.sender
+    mail["To"] = ", ".join(recipients)
+    mail.set_content("".join(parts))
+    return mail
+
+  def flush(self):
+    with self.lock:
+      msgs = self.queue
+      overflow = self.overflow
+      self.queue = []
+      self.overflow = {}
+      self.last = time.time()
+    if len(msgs) == 0 and len(overflow) == 0:
+      return
+    batches = {}
+    for (recipients, msg) in msgs:
+      batches.setdefault(recipients, ([], {}))[0].append(msg)
+    for ((recipients, rule, directive), count) in overflow.items():
+      batches.setdefault(recipients, ([], {}))[1][(rule, directive)] = count
+    logging.info(" -- notify via email --")
+    unsent = list(batches.items())
+    try:
+      with smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.timeout) as smtp:
+        while len(unsent) > 0:
+          (recipients, (batchMsgs, batchOverflow)) = unsent[0]
+          to = list(recipients) if recipients is not None else self.recipients
+          try:
+            start = time.time()
+            smtp.send_message(self.build(batchMsgs, batchOverflow, to), self.sender, to)
+            self.latency.observe(time.time() - start)
+            self.sent += 1
+          except smtplib.SMTPRecipientsRefused as e:
+            # sending it again would fail the same way
+            self.failed += 1
+            logging.error("The relay refused the recipients of the notification mail " + ", ".join(to) + ": " + str(e))
+          unsent.pop(0)
+    except (OSError, smtplib.SMTPException) as e:
+      self.failed += 1
+      logging.error("Could not send the notification mail through " + self.smtp_host + ":" + str(self.smtp_port) + ", will retry: " + str(e))
+    if len(unsent) > 0:
+      self.requeue(unsent)
+
+  def _run(self):
+    while not self.stopped.wait(1):
+      period = self.batch_period if self.batch_period > 0 else MAIL_RETRY_PERIOD
+      if time.time() - self.last >= period:
+        self.flush()
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.flush()
@@ -0,0 +1,135 @@
+import os, threading, logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Upper bounds in seconds of the latency histograms buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+# Cumulative histogram, as exposed by prometheus
+class histogram:
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.lock = threading.Lock()
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    with self.lock:
+      i = 0
+      while i < len(self.buckets) and value > self.buckets[i]:
+        i += 1
+      self.counts[i] += 1
+      self.sum += value
+      self.count += 1
+
+  # Returns the (le, cumulated count) of the buckets, the sum and the count of the observations
+  def snapshot(self):
+    with self.lock:
+      cumulated = []
+      total = 0
+      for (bound, count) in zip(self.buckets + ("+Inf",), self.counts):
+        total += count
+        cumulated.append((bound, total))
+      return (cumulated, self.sum, self.count)
+
+def formatLabels(labels):
+  if not labels:
+    return ""
+  escaped = []
+  for (name, value) in sorted(labels.items()):
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    escaped.append(name + '="' + value + '"')
+  return "{" + ",".join(escaped) + "}"
+
+def formatValue(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+# Render metric families in the prometheus text exposition format.
+# A family is a (name, type, help, samples) tuple, samples being (labels dict, value) pairs,
+# or (labels dict, histogram) pairs for histograms.
+def render(families):
+  lines = []
+  for (name, kind, description, samples) in families:
+    lines.append("# HELP " + name + " " + description)
+    lines.append("# TYPE " + name + " " + kind)
+    for (labels, value) in samples:
+      if kind == "histogram":
+        (buckets, total, count) = value.snapshot()
+        for (bound, cumulated) in buckets:
+          bucketLabels = dict(labels)
+          bucketLabels["le"] = str(bound)
+          lines.append(name + "_bucket" + formatLabels(bucketLabels) + " " + str(cumulated))
+        lines.append(name + "_sum" + formatLabels(labels) + " " + formatValue(total))
+        lines.append(name + "_count" + formatLabels(labels) + " " + str(count))
+      else:
+        lines.append(name + formatLabels(labels) + " " + formatValue(value))
+  return "\n".join(lines) + "\n"
+
+# Serves the metrics returned by collect() on http://address:port/metrics, from a daemon thread
+class metricsServer:
+  def __init__(self, collect, port, address="127.0.0.1"):
+    class handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+          self.send_error(404)
+          return
+        try:
+          body = collect().encode("utf-8")
+        except Exception as e:
+          logging.error("Could not collect the metrics: " + str(e))
+          self.send_error(500)
+          return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = ThreadingHTTPServer((address, port), handler)
+    self.thread = threading.Thread(target=self.server.serve_forever, name="notify-metrics")
+    self.thread.daemon = True
+    self.thread.start()
+    logging.info("Serving metrics on http://" + address + ":" + str(self.server.server_address[1]) + "/metrics")
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+# Writes the metrics returned by collect() to a file every interval seconds, for the
+# textfile collector of the prometheus node exporter. The file is replaced atomically.
+class metricsTextfile:
+  def __init__(self, collect, path, interval=15):
+    self.collect = collect
+    self.path = path
+    self.interval = interval
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, name="notify-metrics-textfile")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def write(self):
+    tmp = self.path + ".tmp"
+    try:
+      with open(tmp, "w") as fd:
+        fd.write(self.collect())
+      os.rename(tmp, self.path)
+    except OSError as e:
+      logging.error("Could not write the metrics to " + self.path + ": " + str(e))
+
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      self.write()
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.write()
@@ -1,18 +1,151 @@
-import requests, urllib3, json, configparser, log_tail, os, re, time, glpi, traceback, logging
+import urllib3, configparser, log_tail, dispatch, dedup, routing, metrics, slack, mail, os, re, threading, glpi, traceback, logging
 logger = logging.getLogger(__name__)
 
+NON_COMPLIANT_REPORTS_LOG = "/var/log/rudder/compliance/non-compliant-reports.log"
+CHECKPOINT_FILE = "/var/rudder/plugin-resources/notify-checkpoint.json"
+MAX_CATCHUP_BYTES = 10 * 1024 * 1024
+# Maximum number of reports detailed in a single slack message
+SLACK_MAX_REPORTS = 20
+MAIL_TIMEOUT = 30
+GLPI_TICKET_PREFIX = "[Rudder]"
+
+# Parse a period like "1d2h30m" into seconds
+def parse_period(period):
+    regex = re.compile("([0-9]*)d?([0-9]*)h?([0-9]*)m?")
+    g = list(map(lambda v : 0 if v == '' else int(v), regex.search(period).groups()))
+    return 86400 * g[0] + 3600 * g[1] + 60 * g[2]
+
+# Filters are parsed once into sets, None when the filter is empty
+def parse_filter(conf, filterName):
+    filters = frozenset(filt.strip() for filt in conf.get("FILTERS", filterName, fallback="").split(','))
+    filters = filters - frozenset([''])
+    if len(filters) == 0:
+      return None
+    return filters
+
+# Validated, read-only snapshot of notify.conf.
+# On reload the worker replaces its snapshot by a new one at once, so that the running
+# code never sees a half updated configuration, and an invalid file does not replace a valid one.
+class NotifyConfig:
+    def __init__(self, conf):
+        self.nodeFilter = parse_filter(conf, "nodeFilter")
+        self.ruleFilter = parse_filter(conf, "ruleFilter")
+        self.directiveFilter = parse_filter(conf, "directiveFilter")
+
+        self.mail_on = conf.getboolean("MAIL", "on", fallback=False)
+        self.mail_nospam = conf.getboolean("MAIL", "nospam", fallback=False)
+        self.mail_batch_period = parse_period(conf.get("MAIL", "batch_period", fallback=""))
+        self.mail_recipients = conf.get("MAIL", "recipients", fallback="").split()
+        self.mail_smtp_host = conf.get("MAIL", "smtp_host", fallback="localhost")
+        self.mail_smtp_port = conf.getint("MAIL", "smtp_port", fallback=25)
+        self.mail_sender = conf.get("MAIL", "sender", fallback="")
+        self.mail_max_queue = conf.getint("MAIL", "max_queue", fallback=1000)
+        if self.mail_on and len(self.mail_recipients) == 0:
+            raise ValueError("MAIL is on but no recipients are configured")
+
+        self.slack_on = conf.getboolean("SLACK", "on", fallback=False)
+        self.slack_webhooks = conf.get("SLACK", "webhooks", fallback="").split()
+        if self.slack_on and len(self.slack_webhooks) == 0:
+            raise ValueError("SLACK is on but no webhooks are configured")
+
+        self.glpi_on = conf.getboolean("GLPI", "on", fallback=False)
+        self.glpi_user_token = conf.get("GLPI", "userToken", fallback="")
+        self.glpi_api_token = conf.get("GLPI", "apiToken", fallback="")
+        self.glpi_url = conf.get("GLPI", "url", fallback="")
+        self.glpi_timeout = conf.getfloat("GLPI", "timeout", fallback=30)
+        self.glpi_retries = conf.getint("GLPI", "retries", fallback=3)
+        # The local index of open tickets is reloaded from GLPI every glpi_index_refresh seconds
+        self.glpi_index_refresh = conf.getint("GLPI", "index_refresh", fallback=3600)
+        # What to do when a non-compliance happens again while its ticket is still open:
+        # nothing (skip), add a followup to the ticket, or increase one of its fields (counter)
+        self.glpi_on_recurrence = conf.get("GLPI", "on_recurrence", fallback="skip")
+        self.glpi_counter_field = conf.get("GLPI", "counter_field", fallback="")
+        self.glpi_recurrence_interval = conf.getint("GLPI", "recurrence_interval", fallback=300)
+        if self.glpi_on_recurrence not in ("skip", "followup", "counter"):
+            raise ValueError("GLPI on_recurrence must be skip, followup or counter, not " + self.glpi_on_recurrence)
+        if self.glpi_on_recurrence == "counter" and self.glpi_counter_field == "":
+            raise ValueError("GLPI on_recurrence is counter but no counter_field is configured")
+        if self.glpi_on and "" in (self.glpi_user_token, self.glpi_api_token, self.glpi_url):
+            raise ValueError("GLPI is on but userToken, apiToken or url is missing")
+
+        # Reports matching a [ROUTE <name>] section are sent where it says, the other ones
+        # to all the enabled channels if they pass the global filters
+        channels = [ channel for (channel, on) in (("mail", self.mail_on), ("slack", self.slack_on), ("glpi", self.glpi_on)) if on ]
+        self.routes = routing.routingTable.read(conf, channels)
+        self.default_destinations = tuple((channel, None) for channel in channels)
+
+        self.log_level = conf.get("DAEMON", "log_level", fallback="INFO").upper()
+        if not isinstance(logging.getLevelName(self.log_level), int):
+            raise ValueError("Unknown log_level " + self.log_level)
+
+        # Only read on start
+        self.checkpoint_file = conf.get("DAEMON", "checkpoint_file", fallback=CHECKPOINT_FILE)
+        self.max_catchup_bytes = conf.getint("DAEMON", "max_catchup_bytes", fallback=MAX_CATCHUP_BYTES)
+        self.watch_config = conf.getboolean("DAEMON", "watch_config", fallback=True)
+        self.queue_size = conf.getint("DAEMON", "queue_size", fallback=100)
+        # An identical report is notified at most once every dedup_window seconds on a channel,
+        # the window can be overridden per channel, 0 to notify every report
+        self.dedup_window = conf.getint("DAEMON", "dedup_window", fallback=0)
+        self.dedup_max_entries = conf.getint("DAEMON", "dedup_max_entries", fallback=100000)
+        self.dedup_windows = {
+          channel: conf.getint(channel.upper(), "dedup_window", fallback=self.dedup_window) for channel in ("mail", "slack", "glpi")
+        }
+        if min(self.dedup_windows.values()) < 0 or self.dedup_max_entries < 1:
+            raise ValueError("dedup_window must not be negative and dedup_max_entries must be positive")
+        self.slack_workers = conf.getint("SLACK", "workers", fallback=2)
+        self.slack_timeout = conf.getfloat("SLACK", "timeout", fallback=10)
+        self.slack_retries = conf.getint("SLACK", "retries", fallback=3)
+        # Reports are posted as digests every slack_window seconds, 0 to post them as they come
+        self.slack_window = conf.getint("SLACK", "window", fallback=10)
+        self.slack_samples = conf.getint("SLACK", "samples", fallback=3)
+        self.slack_max_groups = conf.getint("SLACK", "max_groups", fallback=50)
+        self.glpi_workers = conf.getint("GLPI", "workers", fallback=1)
+        # Metrics are served on http://metrics_address:metrics_port/metrics (0 to disable it)
+        # and/or written to metrics_textfile for the node exporter textfile collector
+        self.metrics_port = conf.getint("DAEMON", "metrics_port", fallback=0)
+        self.metrics_address = conf.get("DAEMON", "metrics_address", fallback="127.0.0.1")
+        self.metrics_textfile = conf.get("DAEMON", "metrics_textfile", fallback="")
+        self.metrics_interval = conf.getint("DAEMON", "metrics_interval", fallback=15)
+
+    @staticmethod
+    def read(conffile):
+        conf = configparser.ConfigParser()
+        with open(conffile) as fd:
+            conf.read_file(fd)
+        return NotifyConfig(conf)
+
+
 class NotifyWorker:
 
-    def __init__(self, pipefile, conf):
+    def __init__(self, pipefile, conf, conffile=None):
         self.fifo_pipe = pipefile
-        self.conf = conf
-        self.notif_queue = []
-        self.timestamp = int(time.time())
+        self.config = NotifyConfig(conf)
+        self.conffile = conffile
+        self.confMtime = self.getConfMtime()
+        self.reloadRequested = False
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         self.glpi = None
-        self.nodeFilter = None
-        self.ruleFilter = None
-        self.directiveFilter = None
+        self.glpiIndex = None
+        self.glpiLock = threading.Lock()
+        self.glpiRecurrences = glpi.recurrenceRecorder(lambda: self.glpi, self.config.glpi_on_recurrence,
+                                                       self.config.glpi_counter_field, self.config.glpi_recurrence_interval)
+        self.mail = mail.mailBatcher(*self.mailSettings(self.config))
+        self.slack = slack.slackClient(self.config.slack_timeout, self.config.slack_retries)
+        self.slackDigest = slack.slackDigest(lambda text, webhooks: self.slack.send(webhooks or self.config.slack_webhooks, text),
+                                             self.config.slack_window, self.config.slack_samples, self.config.slack_max_groups,
+                                             on_failure=lambda keys, webhooks: self.dedup.forget(keys, ("slack", webhooks)))
+        self.follower = None
+        self.metricsServer = None
+        self.metricsTextfile = None
+        # Counters of the reports read, see metrics()
+        self.counters = { "lines": 0, "parse_failures": 0, "filtered": 0, "duplicates": 0, "routed": 0 }
+        self.dedup = dedup.reportCache(self.config.dedup_windows, self.config.dedup_max_entries)
+        # Each channel sends its notifications from its own threads, mails are sent from a single one
+        self.dispatchers = {
+          "mail": dispatch.channelDispatcher("mail", self.deliver("mail", self.notify_mail), 1, self.config.queue_size),
+          "slack": dispatch.channelDispatcher("slack", self.deliver("slack", self.notify_slack), self.config.slack_workers, self.config.queue_size),
+          "glpi": dispatch.channelDispatcher("glpi", self.deliver("glpi", self.notify_glpi), self.config.glpi_workers, self.config.queue_size)
+        }
         try:
             os.mkfifo(self.fifo_pipe)
         except OSError as e:
@@ -23,182 +156,381 @@ class NotifyWorker:
     # It is meant to be used with the Rudder server non-compliance hooks.
     def run(self):
         while True:
-            if self.timestamp % 60 == 0: # This will check if there are unsent mails in the queue, and send them if the batch period is elapsed
-                self.notify_mail()
             with open(self.fifo_pipe) as pipe:
-                self.handle_non_compliance(pipe.read())
+                self.handle_batch(pipe.read().splitlines())
 
     # This function reads its input from the Rudder server non-compliance logs directly.
     # It is a temporary solution, used until the server's non-compliance hooks are implemented.
+    # The position in the log is checkpointed, so that the reports written while the daemon
+    # was stopped are notified (by batches) when it starts again.
     def run_with_logtail(self):
-        for line in log_tail.log_tail("/var/log/rudder/compliance/non-compliant-reports.log"):
-            self.handle_non_compliance(line)
+        self.follower = log_tail.LogFollower(NON_COMPLIANT_REPORTS_LOG,
+                                             checkpoint_file=self.config.checkpoint_file,
+                                             max_catchup_bytes=self.config.max_catchup_bytes,
+                                             on_idle=self.reloadIfChanged)
+        try:
+            for lines in self.follower.batches():
+                self.handle_batch(lines, self.follower.catching_up)
+        finally:
+            # the position in the log is saved even if stopping the channels fails
+            try:
+                self.stop()
+            finally:
+                self.follower.close()
+
+    # Wait for the queued notifications to be sent
+    def stop(self):
+        for dispatcher in self.dispatchers.values():
+            dispatcher.stop()
+        self.slackDigest.stop()
+        self.mail.stop()
+        self.glpiRecurrences.stop()
+        if self.glpi is not None:
+            self.glpi.killSession()
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+        if self.metricsTextfile is not None:
+            self.metricsTextfile.stop()
+
+    def stats(self):
+        stats = { name: dispatcher.stats() for (name, dispatcher) in self.dispatchers.items() }
+        stats["slack"]["digest"] = self.slackDigest.stats()
+        stats["slack"]["client"] = self.slack.stats()
+        stats["mail"]["batch"] = self.mail.stats()
+        stats["dedup"] = self.dedup.stats()
+        if self.glpiIndex is not None:
+          stats["glpi"]["index"] = self.glpiIndex.stats()
+        stats["glpi"]["recurrences"] = self.glpiRecurrences.stats()
+        return stats
+
+    # The stats of the worker, in the prometheus text format
+    def metrics(self):
+        stats = self.stats()
+        channels = list(self.dispatchers.keys())
+        # Mails and slack posts are sent after being dispatched, by the mail batcher and the
+        # slack client: the dispatcher only measures the GLPI calls
+        sent = { "mail": stats["mail"]["batch"]["sent"], "slack": stats["slack"]["client"]["sent"], "glpi": stats["glpi"]["sent"] }
+        failed = { "mail": stats["mail"]["batch"]["failed"], "slack": stats["slack"]["client"]["failed"], "glpi": stats["glpi"]["failed"] }
+        latencies = { "mail": self.mail.latency, "slack": self.slack.latency, "glpi": self.dispatchers["glpi"].latency }
+        families = [
+          ("rudder_notify_lines_total", "counter", "Non-compliance log lines read", [ ({}, self.counters["lines"]) ]),
+          ("rudder_notify_parse_failures_total", "counter", "Lines that could not be parsed", [ ({}, self.counters["parse_failures"]) ]),
+          ("rudder_notify_filtered_total", "counter", "Reports dropped by the global filters", [ ({}, self.counters["filtered"]) ]),
+          ("rudder_notify_duplicates_total", "counter", "Reports identical to another one of the same batch", [ ({}, self.counters["duplicates"]) ]),
+          ("rudder_notify_routed_total", "counter", "Reports matching a route", [ ({}, self.counters["routed"]) ]),
+          ("rudder_notify_suppressed_total", "counter", "Reports already notified during the dedup window",
+            [ ({ "channel": channel }, stats["dedup"]["suppressed"].get(channel, 0)) for channel in channels ]),
+          ("rudder_notify_dedup_entries", "gauge", "Distinct reports in the dedup cache", [ ({}, stats["dedup"]["size"]) ]),
+          ("rudder_notify_sent_total", "counter", "Notifications sent by a channel (mails, slack posts, GLPI report batches)",
+            [ ({ "channel": channel }, sent[channel]) for channel in channels ]),
+          ("rudder_notify_failed_total", "counter", "Notifications a channel failed to send", [ ({ "channel": channel }, failed[channel]) for channel in channels ]),
+          ("rudder_notify_blocked_total", "counter", "Times the log reading waited for a full channel queue", [ ({ "channel": channel }, stats[channel]["blocked"]) for channel in channels ]),
+          ("rudder_notify_queue_depth", "gauge", "Report batches waiting in a channel queue", [ ({ "channel": channel }, stats[channel]["queue_depth"]) for channel in channels ]),
+          ("rudder_notify_send_duration_seconds", "histogram", "Time taken by a channel to send a notification",
+            [ ({ "channel": channel }, latencies[channel]) for channel in channels ]),
+          ("rudder_notify_pending", "gauge", "Reports waiting for the next mail, slack digest or GLPI recurrence update",
+            [ ({ "channel": "mail" }, stats["mail"]["batch"]["pending"]), ({ "channel": "slack" }, stats["slack"]["digest"]["pending"]),
+              ({ "channel": "glpi" }, stats["glpi"]["recurrences"]["pending"]) ])
+        ]
+        if self.follower is not None:
+          families.append(("rudder_notify_tail_lag_bytes", "gauge", "Bytes of the non-compliance log not read yet", [ ({}, self.follower.lag_bytes()) ]))
+          families.append(("rudder_notify_tail_lines_per_second", "gauge", "Lines read from the non-compliance log per second", [ ({}, self.follower.lines_per_second) ]))
+        if "index" in stats["glpi"]:
+          index = stats["glpi"]["index"]
+          families.append(("rudder_notify_glpi_index_size", "gauge", "Open GLPI tickets in the local index", [ ({}, index["size"]) ]))
+          families.append(("rudder_notify_glpi_index_lookups_total", "counter", "Lookups in the local index of GLPI tickets",
+                           [ ({ "result": "hit" }, index["hits"]), ({ "result": "miss" }, index["misses"]) ]))
+        return metrics.render(families)
+
+    def startMetrics(self):
+        if self.config.metrics_port > 0:
+          try:
+            self.metricsServer = metrics.metricsServer(self.metrics, self.config.metrics_port, self.config.metrics_address)
+          except OSError as e:
+            logging.error("Could not serve the metrics on " + self.config.metrics_address + ":" + str(self.config.metrics_port) + ": " + str(e))
+        if self.config.metrics_textfile != "":
+          self.metricsTextfile = metrics.metricsTextfile(self.metrics, self.config.metrics_textfile, self.config.metrics_interval)
 
     def start(self):
+        self.startMetrics()
         #self.run()
         self.run_with_logtail()
 
-    def getFilters(self, filterName):
-      try:
-        filters = (self.conf["FILTERS"][filterName]).split(',')
-        if isinstance(filters, list):
-          if all('' == filt or filt.isspace() for filt in filters):
-            return None
-          else:
-            return filters
+    def getConfMtime(self):
+      if self.conffile is None:
         return None
-      except:
+      try:
+        return os.stat(self.conffile).st_mtime
+      except OSError:
         return None
 
+    # Replace the configuration by the content of the configuration file, if it is valid.
+    # The log follower, the pending mails and the GLPI session are kept.
+    # Called before a batch and while waiting for reports, on SIGHUP (see requestReload)
+    # or when the file changed if watch_config is set.
+    def reload(self):
+      if self.conffile is None:
+        return False
+      self.confMtime = self.getConfMtime()
+      try:
+        config = NotifyConfig.read(self.conffile)
+      except (OSError, configparser.Error, ValueError) as e:
+        logging.error("Invalid configuration in " + self.conffile + ", keeping the current one: " + str(e))
+        return False
+      previous = self.config
+      self.config = config
+      if (previous.glpi_url, previous.glpi_user_token, previous.glpi_api_token) != (config.glpi_url, config.glpi_user_token, config.glpi_api_token):
+        with self.glpiLock:
+          session = self.glpi
+          self.glpi = None
+          self.glpiIndex = None
+        # A new session is opened with the next batch
+        if session is not None:
+          session.killSession()
+        # Ticket ids of another GLPI server are meaningless
+        if previous.glpi_url != config.glpi_url:
+          self.glpiRecurrences.clear()
+      self.glpiRecurrences.configure(config.glpi_on_recurrence, config.glpi_counter_field, config.glpi_recurrence_interval)
+      self.slack.configure(config.slack_timeout, config.slack_retries)
+      self.slackDigest.configure(config.slack_window, config.slack_samples, config.slack_max_groups)
+      self.mail.configure(*self.mailSettings(config))
+      self.dedup.configure(config.dedup_windows, config.dedup_max_entries)
+      logging.getLogger().setLevel(config.log_level)
+      logging.info("Configuration reloaded from " + self.conffile)
+      return True
+
+    # Called from the SIGHUP handler, which interrupts the main thread anywhere (possibly
+    # holding a lock reload() needs): only flag the reload, done by reloadIfChanged()
+    def requestReload(self):
+      self.reloadRequested = True
+
+    def reloadIfChanged(self):
+      if self.reloadRequested:
+        self.reloadRequested = False
+        self.reload()
+      elif self.config.watch_config and self.getConfMtime() != self.confMtime:
+        self.reload()
 
     def handle_non_compliance(self, msg_str):
-      try:
-        self.nodeFilter = self.getFilters("nodeFilter")
-        self.ruleFilter = self.getFilters("ruleFilter")
-        self.directiveFilter = self.getFilters("directiveFilter")
-
-        msg = Message(msg_str)
-
-        logging.info("parsing line: " + msg_str)
-        if self.applyGlobalFilters(msg) == True:
-          if self.conf["MAIL"]["on"] == "true":
-            self.notif_queue.append(msg)
-            self.notify_mail()
-          if self.conf["SLACK"]["on"] == "true":
-            self.notify_slack(msg)
-          if self.conf["GLPI"]["on"] == "true":
-            self.notify_glpi(msg)
-      except Exception as e:
-        logging.error("Something went wrong while parsing the ticket: " + str(e))
-
-
-    def notify_slack(self, msg):
-      logging.info(" -- notify via slack --")
-      for webhook in self.conf["SLACK"]["webhooks"].split(' '):
-        requests.post(webhook, headers={"Content-type":"application/json"}, data=json.dumps({
-            "text":"*RUDDER NON-COMPLIANCE*\n" + str(msg)
-            }))
-
-    def notify_glpi(self, msg):
-       logging.info(" -- notify via glpi --")
-       if (self.glpi == None):
-         newSession = glpi.glpiSession(self.conf["GLPI"]["userToken"], self.conf["GLPI"]["apiToken"], self.conf["GLPI"]["url"])
-         newSession.initSession()
-         self.glpi = newSession
-
-       # Do not parse repaired reports or logs
-       if (msg.getResultStatus() != "result_repaired" and msg.getResultStatus() != "log_repaired" and msg.getResultStatus() != "log_warn"):
-         ticketName = "[Rudder]" + msg.data['directive_name']
-         ticketContent = str(msg)
-         lookedContent = msg.withoutTimeStamp()
-         lookedStatus = ['new', 'assigned', 'planned', 'pending']
-
-         logging.info("looking for ticket: " + ticketName + "\n with content" + lookedContent)
-         sampleTicket = glpi.glpiTicket(ticketName, lookedContent)
-         if not self.glpi.similarTicketExists(sampleTicket, lookedStatus):
-           logging.info(" -- creating ticket --")
-           self.glpi.openTicket(ticketName, ticketContent)
-           logging.info(" -- done --\n\n")
+      self.handle_batch([msg_str])
+
+    # Handle all the lines available at once: filters are read once, identical reports
+    # are notified once, and each destination is called once for the whole batch
+    # (one mail, one slack message, one GLPI search per distinct ticket).
+    # Reports already notified on a channel during its dedup window are not sent to it again.
+    def handle_batch(self, lines, backlog=False):
+      self.reloadIfChanged()
+      config = self.config
+
+      self.counters["lines"] += len(lines)
+      # (channel, targets) -> reports
+      deliveries = {}
+      count = 0
+      seen = set()
+      for line in lines:
+        try:
+          msg = Message(line)
+        except ValueError as e:
+          self.counters["parse_failures"] += 1
+          logging.error("Could not parse line '" + line + "': " + str(e))
+          continue
+        logging.debug("parsing line: " + line)
+        key = msg.key()
+        if key in seen:
+          self.counters["duplicates"] += 1
+          continue
+        destinations = config.routes.route(msg)
+        if destinations is None:
+          if self.applyGlobalFilters(msg, config) != True:
+            self.counters["filtered"] += 1
+            continue
+          destinations = config.default_destinations
+        else:
+          self.counters["routed"] += 1
+        seen.add(key)
+        count += 1
+        for destination in destinations:
+          deliveries.setdefault(destination, []).append(msg)
+      if count == 0:
+        return
+
+      if backlog:
+        logging.info("Catching up " + str(count) + " reports written while the notifier was stopped")
+      for (destination, msgs) in deliveries.items():
+        msgs = self.dedup.filter(msgs, [ destination ])[destination]
+        if len(msgs) > 0:
+          self.dispatchers[destination[0]].submit(msgs, backlog, destination[1])
+
+    # The dedup cache records the reports as notified when they are dispatched: when the
+    # channel fails to send them, they are forgotten to be notified the next time they are read.
+    # Mails which could not be sent are retried by the mail batcher, failed slack digests
+    # are forgotten by the digest itself.
+    def deliver(self, channel, handler):
+      def send(msgs, backlog=False, targets=None):
+        try:
+          handler(msgs, backlog, targets)
+        except Exception:
+          self.dedup.forget([ msg.key() for msg in msgs ], (channel, targets))
+          raise
+      return send
+
+    # webhooks is None for the webhooks of the SLACK section
+    def notify_slack(self, msgs, backlog=False, webhooks=None):
+      logging.debug(" -- notify via slack --")
+      if self.config.slack_window > 0:
+        self.slackDigest.add(msgs, webhooks)
+        return
+      self.slackDigest.flush()
+      if len(msgs) == 1 and not backlog:
+        text = "*RUDDER NON-COMPLIANCE*\n" + str(msgs[0])
+      else:
+        text = "*RUDDER NON-COMPLIANCE* (" + str(len(msgs)) + " reports" + (" written while the notifier was stopped" if backlog else "") + ")\n"
+        text += "\n".join(str(msg) for msg in msgs[:SLACK_MAX_REPORTS])
+        if len(msgs) > SLACK_MAX_REPORTS:
+          text += "\n... and " + str(len(msgs) - SLACK_MAX_REPORTS) + " more"
+      self.slack.send(webhooks or self.config.slack_webhooks, text)
+
+    # Opens one ticket per distinct (directive, node) of the batch, unless a similar one is still open.
+    # Open tickets are first looked for in the local index, then in GLPI.
+    # Unless on_recurrence is skip, the reports matching an open ticket are recorded on it.
+    def notify_glpi(self, msgs, backlog=False, targets=None):
+       logging.debug(" -- notify via glpi --")
+       with self.glpiLock:
+         if (self.glpi == None):
+           newSession = glpi.glpiSession(self.config.glpi_user_token, self.config.glpi_api_token, self.config.glpi_url,
+                                         self.config.glpi_timeout, self.config.glpi_retries)
+           newSession.initSession()
+           self.glpi = newSession
+         # The session is kept when the index cannot be loaded, it is loaded again with the next batch
+         if (self.glpiIndex == None):
+           newIndex = glpi.ticketIndex(self.glpi, GLPI_TICKET_PREFIX, self.config.glpi_index_refresh)
+           newIndex.load()
+           self.glpiIndex = newIndex
+         session = self.glpi
+         index = self.glpiIndex
+         index.refresh = self.config.glpi_index_refresh
+         index.reloadIfExpired()
+
+       lookedStatus = ['new', 'assigned', 'planned', 'pending']
+       tickets = {}
+       for msg in msgs:
+         # Do not parse repaired reports or logs
+         if (msg.getResultStatus() != "result_repaired" and msg.getResultStatus() != "log_repaired" and msg.getResultStatus() != "log_warn"):
+           ticketName = GLPI_TICKET_PREFIX + msg.directive_name
+           lookedContent = msg.withoutTimeStamp()
+           if (ticketName, lookedContent) not in tickets:
+             tickets[(ticketName, lookedContent)] = msg
          else:
-           logging.info(" -- SKIPPING, ticket already exists --")
-       else:
-         logging.info(" -- SKIPPING, repaired report --")
-
-    def notify_mail(self):
-        logging.info(" -- notify via email --")
-        if self.conf["MAIL"]["nospam"] == "true" and time.time() - self.timestamp < self.get_mail_batch_period():
-            return
-            # The code above is enabling batch mail-sending by checking if the configured period has elapsed since last mail
-
-        tmp_mailfile = "/tmp/rudder-notify-mail.txt"
-        with open(tmp_mailfile, 'a') as out:
-            out.write(str(len(self.notif_queue)) + " notification" + ('s' if len(self.notif_queue) > 1 else '') + " from Rudder :\n")
-            for i in range(0, len(self.notif_queue)):
-                out.write("# " + str(i+1) + ' :\n' + str(self.notif_queue[i]) + '\n')
-        self.notif_queue = []
-        for recipient in self.conf["MAIL"]["recipients"].split(' '):
-            os.system("mail -s 'Rudder non-compliance notification' " + recipient + " < " + tmp_mailfile)
-        os.remove(tmp_mailfile)
-        self.timestamp = time.time() # And we reset the timestamp
-
-    def get_mail_batch_period(self):
-        regex = re.compile("([0-9]*)d?([0-9]*)h?([0-9]*)m?")
-        g = list(map(lambda v : 0 if v == '' else int(v), regex.search(self.conf["MAIL"]["batch_period"]).groups()))
-        return 86400 * g[0] + 3600 * g[1] + 60 * g[2]
-
-    def filterByNode(self, msg):
-        if isinstance(self.nodeFilter, list):
-          if msg.data['node_uuid'] in self.nodeFilter:
-            return True
-        return False
+           logging.debug(" -- SKIPPING, repaired report --")
 
-    def filterByDirective(self, msg):
-        if isinstance(self.directiveFilter, list):
-          if msg.data['directive_uuid'] in self.directiveFilter:
-            return True
-        return False
+       recurrence = self.config.glpi_on_recurrence != "skip"
+       newTickets = []
+       for (ticketName, lookedContent), msg in tickets.items():
+         ticketId = index.find(ticketName, lookedContent)
+         if ticketId is None:
+           logging.debug("looking for ticket: " + ticketName + "\n with content" + lookedContent)
+           sampleTicket = glpi.glpiTicket(ticketName, lookedContent)
+           ticketId = session.findSimilarTicket(sampleTicket, lookedStatus)
+           if ticketId is None:
+             newTickets.append((ticketName, lookedContent, str(msg)))
+             continue
+           index.add(ticketName, lookedContent, ticketId)
+         logging.debug(" -- SKIPPING, ticket already exists --")
+         if recurrence:
+           self.glpiRecurrences.add(ticketId, msg.date, str(msg))
 
-    def filterByRule(self, msg):
-        if isinstance(self.ruleFilter, list):
-          if msg.data['rule_uuid'] in self.ruleFilter:
-            return True
-        return False
+       # All the new tickets of the batch are created at once
+       if len(newTickets) > 0:
+         logging.info(" -- creating " + str(len(newTickets)) + " tickets --")
+         ids = session.openTickets([ (ticketName, ticketContent) for (ticketName, lookedContent, ticketContent) in newTickets ])
+         for (iTicket, ticketId) in enumerate(ids):
+           if ticketId is not None:
+             index.add(newTickets[iTicket][0], newTickets[iTicket][1], ticketId)
+         logging.debug(" -- done --")
+
+    # Mails are sent in batches every batch_period when nospam is set, right away otherwise
+    def mailSettings(self, config):
+        batch_period = config.mail_batch_period if config.mail_nospam else 0
+        return (config.mail_recipients, batch_period, config.mail_smtp_host, config.mail_smtp_port,
+                config.mail_sender, config.mail_max_queue, MAIL_TIMEOUT)
+
+    # recipients is None for the recipients of the MAIL section
+    def notify_mail(self, msgs, backlog=False, recipients=None):
+        self.mail.add(msgs, recipients)
+
+    def filterByNode(self, msg, config):
+        return config.nodeFilter is not None and msg.node_uuid in config.nodeFilter
+
+    def filterByDirective(self, msg, config):
+        return config.directiveFilter is not None and msg.directive_uuid in config.directiveFilter
 
-    def applyGlobalFilters(self, msg):
-      if self.filterByNode(msg) == True:
-        logging.info(" -- Node " + msg.data['node_uuid'] + " in the whitelist --")
+    def filterByRule(self, msg, config):
+        return config.ruleFilter is not None and msg.rule_uuid in config.ruleFilter
+
+    def applyGlobalFilters(self, msg, config):
+      if self.filterByNode(msg, config):
+        logging.debug(" -- Node %s in the whitelist --", msg.node_uuid)
         return True
-      elif self.filterByDirective(msg) == True:
-        logging.info(" -- Directive " + msg.data['directive_uuid'] + " in the whitelist --")
+      elif self.filterByDirective(msg, config):
+        logging.debug(" -- Directive %s in the whitelist --", msg.directive_uuid)
         return True
-      elif self.filterByRule(msg) == True:
-        logging.info(" -- Rule " + msg.data['rule_uuid'] + " in the whitelist --")
+      elif self.filterByRule(msg, config):
+        logging.debug(" -- Rule %s in the whitelist --", msg.rule_uuid)
         return True
-      elif self.nodeFilter == None and self.directiveFilter == None and self.ruleFilter == None:
-        logging.info(" -- No global filter set --\n\n")
+      elif config.nodeFilter is None and config.directiveFilter is None and config.ruleFilter is None:
+        logging.debug(" -- No global filter set --")
         return True
       else:
-        logging.info(" -- Skipping because not matching any global filter --")
+        logging.debug(" -- Skipping because not matching any global filter --")
         return False
 
+# A non-compliance report line, as written in the non-compliance log
+MESSAGE_REGEX = re.compile(r"^\[(?P<Date>[^\]]+)\] N: (?P<NodeUUID>[^ ]+) \[(?P<NodeFQDN>[^\]]+)\] S: \[(?P<Result>[^\]]+)\] R: (?P<RuleUUID>[^ ]+) \[(?P<RuleName>[^\]]+)\] D: (?P<DirectiveUUID>[^ ]+) \[(?P<DirectiveName>[^\]]+)\] T: (?P<TechniqueName>[^/]+)/(?P<TechniqueVersion>[^ ]+) C: \[(?P<ComponentName>[^\]]+)\] V: \[(?P<ComponentKey>[^\]]+)\] (?P<Message>.+)$")
+MESSAGE_FIELDS = ("date", "node_uuid", "node_fqdn", "result", "rule_uuid", "rule_name", "directive_uuid",
+                  "directive_name", "technique_name", "technique_version", "component_name", "component_key", "message")
+MESSAGE_FORMAT = " - Date: {}\n - Node UUID: {}\n - Node FQDN: {}\n - Result: {}\n - Rule UUID: {}\n - Rule name: {}" \
+                 "\n - Directive UUID: {}\n - Directive name: {}\n - Technique name: {}\n - Technique version: {}" \
+                 "\n - Component name: {}\n - Component key: {}\n - Message: {}\n"
+
+# Fields are read from the regex groups, the data dict and the string rendering are only built when used.
+# Raises a ValueError if the line is not a report.
 class Message:
+    __slots__ = ("groups", "_data", "_str")
+
     def __init__(self, msg):
-        regex = re.compile(r"^\[(?P<Date>[^\]]+)\] N: (?P<NodeUUID>[^ ]+) \[(?P<NodeFQDN>[^\]]+)\] S: \[(?P<Result>[^\]]+)\] R: (?P<RuleUUID>[^ ]+) \[(?P<RuleName>[^\]]+)\] D: (?P<DirectiveUUID>[^ ]+) \[(?P<DirectiveName>[^\]]+)\] T: (?P<TechniqueName>[^/]+)/(?P<TechniqueVersion>[^ ]+) C: \[(?P<ComponentName>[^\]]+)\] V: \[(?P<ComponentKey>[^\]]+)\] (?P<Message>.+)$")
-        groups = regex.search(msg).groups()
-        self.data = {
-                    "date": groups[0],
-                    "node_uuid": groups[1],
-                    "node_fqdn": groups[2],
-                    "result": groups[3],
-                    "rule_uuid": groups[4],
-                    "rule_name": groups[5],
-                    "directive_uuid": groups[6],
-                    "directive_name": groups[7],
-                    "technique_name": groups[8],
-                    "technique_version": groups[9],
-                    "component_name": groups[10],
-                    "component_key": groups[11],
-                    "message": groups[12]
-                }
+        # Quick check so that lines which are obviously not reports do not go through the regex
+        if not msg.startswith("[") or msg.find("] N: ", 1, 64) < 0:
+            raise ValueError("not a non-compliance report")
+        match = MESSAGE_REGEX.match(msg)
+        if match is None:
+            raise ValueError("malformed non-compliance report")
+        self.groups = match.groups()
+        self._data = None
+        self._str = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = dict(zip(MESSAGE_FIELDS, self.groups))
+        return self._data
 
     def __str__(self):
-        return " - Date: " + self.data["date"] + \
-            "\n - Node UUID: " + self.data["node_uuid"] + \
-            "\n - Node FQDN: " + self.data["node_fqdn"] + \
-            "\n - Result: " + self.data["result"] + \
-            "\n - Rule UUID: " + self.data["rule_uuid"] + \
-            "\n - Rule name: " + self.data["rule_name"] + \
-            "\n - Directive UUID: " + self.data["directive_uuid"] + \
-            "\n - Directive name: " + self.data["directive_name"] + \
-            "\n - Technique name: " + self.data["technique_name"] + \
-            "\n - Technique version: " + self.data["technique_version"] + \
-            "\n - Component name: " + self.data["component_name"] + \
-            "\n - Component key: " + self.data["component_key"] + \
-            "\n - Message: " + self.data["message"] + "\n"
+        if self._str is None:
+            self._str = MESSAGE_FORMAT.format(*self.groups)
+        return self._str
+
+    # Identifies the report regardless of its date
+    def key(self):
+      return self.groups[1:]
 
     def withoutTimeStamp(self):
-      return self.__str__().split("\n")[1]
+      return " - Node UUID: " + self.groups[1]
 
     def getResultStatus(self):
-      return self.data['result']
+      return self.groups[3]
+
+def _messageField(index):
+    return property(lambda self: self.groups[index])
 
+for _index, _field in enumerate(MESSAGE_FIELDS):
+    setattr(Message, _field, _messageField(_index))
@@ -4,14 +4,25 @@ sys.path.insert(0, "/opt/rudder/share/python")
 import notify
 
 FIFO_PIPE = "/var/run/rudder-notifyd.fifo"
+CONF_FILE = "/opt/rudder/etc/notify.conf"
+
+# Exit cleanly on stop, so that the worker saves its position in the log
+def stop_worker(signum, frame):
+  logging.info('Stopping the notify Rudder plugin')
+  sys.exit(0)
 
 def start_worker():
   try:
-    logging.basicConfig(filename='/var/log/rudder/notify.log', level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-    logging.info('Starting the notify Rudder plugin')
     conf = configparser.ConfigParser()
-    conf.read("/opt/rudder/etc/notify.conf")
-    w = notify.NotifyWorker(FIFO_PIPE, conf)
+    conf.read(CONF_FILE)
+    # Each line read is only logged at the DEBUG level
+    level = conf.get("DAEMON", "log_level", fallback="INFO").upper()
+    logging.basicConfig(filename='/var/log/rudder/notify.log', level=level if isinstance(logging.getLevelName(level), int) else logging.INFO,
+                        format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    logging.info('Starting the notify Rudder plugin')
+    w = notify.NotifyWorker(FIFO_PIPE, conf, CONF_FILE)
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGHUP, lambda signum, frame: w.requestReload())
     w.start()
   except Exception as e:
     logging.error("An error occurred in the worker: " + str(e))
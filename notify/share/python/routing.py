@@ -0,0 +1,131 @@
+import re, functools
+
+CHANNELS = ("mail", "slack", "glpi")
+# Route keys matched on exact values, and the Message field they are matched against
+INDEXED_FIELDS = (("results", "result"), ("nodes", "node_uuid"), ("rules", "rule_uuid"),
+                  ("directives", "directive_uuid"), ("techniques", "technique_name"))
+
+def parse_values(section, key):
+  values = frozenset(value.strip() for value in section.get(key, fallback="").split(',')) - frozenset([''])
+  return values if len(values) > 0 else None
+
+# A [ROUTE <name>] section of notify.conf: the reports matching all its conditions
+# (any of the listed values for each key, a regex searched in the component name)
+# are sent to its channels, to its own mail recipients and slack webhooks if set.
+class route:
+  def __init__(self, name, section):
+    self.name = name
+    self.values = { key: parse_values(section, key) for (key, field) in INDEXED_FIELDS }
+    self.component = section.get("component", fallback="")
+    if self.component != "":
+      try:
+        re.compile(self.component)
+      except re.error as e:
+        raise ValueError("Invalid component regex in route " + name + ": " + str(e))
+    self.channels = tuple(section.get("channels", fallback=" ".join(CHANNELS)).split())
+    for channel in self.channels:
+      if channel not in CHANNELS:
+        raise ValueError("Unknown channel " + channel + " in route " + name)
+    recipients = section.get("recipients", fallback="").split()
+    webhooks = section.get("webhooks", fallback="").split()
+    # None stands for the recipients or webhooks of the channel section
+    self.targets = { "mail": tuple(recipients) if len(recipients) > 0 else None,
+                     "slack": tuple(webhooks) if len(webhooks) > 0 else None,
+                     "glpi": None }
+
+  def destinations(self):
+    return [ (channel, self.targets[channel]) for channel in self.channels ]
+
+# Routes compiled into indexes, so that the cost of routing a report does not grow with
+# the number of routes:
+#  - routes are numbered, a set of routes is an integer bit mask
+#  - for each exact match key, a dict gives the mask of the routes accepting a value, and
+#    another mask the routes without condition on that key: a report is routed with one
+#    dict lookup per key
+#  - the component regexes are combined into a single one, used to skip the reports
+#    matching none of them (when they can be combined), and the routes matching a
+#    component name are cached
+#  - the destinations of a set of routes are computed once and cached
+class routingTable:
+  def __init__(self, routes, channels=CHANNELS):
+    self.routes = routes
+    self.channels = frozenset(channels)
+    self.all = (1 << len(routes)) - 1
+    self.indexes = {}
+    self.wildcards = {}
+    for (key, field) in INDEXED_FIELDS:
+      index = {}
+      wildcard = 0
+      for (i, r) in enumerate(routes):
+        if r.values[key] is None:
+          wildcard |= 1 << i
+        else:
+          for value in r.values[key]:
+            index[value] = index.get(value, 0) | (1 << i)
+      # keys without condition in any route are not looked up
+      if wildcard != self.all:
+        self.indexes[field] = index
+        self.wildcards[field] = wildcard
+    self.patterns = [ (1 << i, re.compile(r.component)) for (i, r) in enumerate(routes) if r.component != "" ]
+    self.patternRoutes = 0
+    for (bit, pattern) in self.patterns:
+      self.patternRoutes |= bit
+    # Groups are numbered across the whole combined regex, which breaks backreferences and
+    # duplicates the named groups, and global flags are only accepted at its start: such
+    # regexes are only searched one by one
+    self.combined = None
+    if len(self.patterns) > 0 and all(pattern.groups == 0 for (bit, pattern) in self.patterns):
+      try:
+        self.combined = re.compile("|".join("(?:" + pattern.pattern + ")" for (bit, pattern) in self.patterns))
+      except re.error:
+        self.combined = None
+    self.componentMask = functools.lru_cache(4096)(self._componentMask)
+    self.destinationCache = {}
+
+  @staticmethod
+  def read(conf, channels=CHANNELS):
+    routes = [ route(name[len("ROUTE "):].strip(), conf[name]) for name in conf.sections() if name.startswith("ROUTE ") ]
+    return routingTable(routes, channels)
+
+  def __len__(self):
+    return len(self.routes)
+
+  # Mask of the routes whose regex matches the component name
+  def _componentMask(self, component):
+    if self.combined is not None and self.combined.search(component) is None:
+      return 0
+    mask = 0
+    for (bit, pattern) in self.patterns:
+      if pattern.search(component) is not None:
+        mask |= bit
+    return mask
+
+  def match(self, msg):
+    mask = self.all
+    for (field, index) in self.indexes.items():
+      mask &= index.get(getattr(msg, field), 0) | self.wildcards[field]
+      if mask == 0:
+        return 0
+    if mask & self.patternRoutes:
+      mask &= ~self.patternRoutes | self.componentMask(msg.component_name)
+    return mask
+
+  # Returns the (channel, targets) the report is routed to, None when it matches no route
+  def route(self, msg):
+    mask = self.match(msg) if len(self.routes) > 0 else 0
+    if mask == 0:
+      return None
+    destinations = self.destinationCache.get(mask)
+    if destinations is None:
+      destinations = []
+      routes = mask
+      while routes:
+        # lowest route of the mask
+        bit = routes & -routes
+        routes ^= bit
+        for destination in self.routes[bit.bit_length() - 1].destinations():
+          if destination[0] in self.channels and destination not in destinations:
+            destinations.append(destination)
+      destinations = tuple(destinations)
+      self.destinationCache[mask] = destinations
+    return destinations
@@ -0,0 +1,199 @@
+import requests, random, time, threading, logging, metrics
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+# HTTP codes worth retrying: rate limiting and server errors
+RETRIED_CODES = frozenset([429, 500, 502, 503, 504])
+
+class slackError(Exception):
+  pass
+
+# Posts messages to slack incoming webhooks:
+#  - one keep-alive connection pool per webhook host, shared by all the messages
+#  - a message is posted to all the webhooks in parallel
+#  - rate limited (429) and failed (5xx) posts are retried with an exponential backoff,
+#    or after the delay given by slack in the Retry-After header
+class slackClient:
+  def __init__(self, timeout=10, retries=3, backoff=1.0, max_retry_after=60, fanout=8):
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.max_retry_after = max_retry_after
+    self.fanout = fanout
+    self.sessions = {}
+    self.lock = threading.Lock()
+    self.sent = 0
+    self.failed = 0
+    self.latency = metrics.histogram()
+    self.executor = ThreadPoolExecutor(max_workers=fanout)
+
+  def configure(self, timeout, retries):
+    self.timeout = timeout
+    self.retries = retries
+
+  def session(self, webhook):
+    host = urlsplit(webhook).netloc
+    with self.lock:
+      if host not in self.sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.fanout)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({ "Content-type": "application/json" })
+        self.sessions[host] = session
+      return self.sessions[host]
+
+  def retryDelay(self, attempt, response):
+    if response is not None and response.headers.get("Retry-After") is not None:
+      try:
+        return min(float(response.headers["Retry-After"]), self.max_retry_after)
+      except ValueError:
+        pass
+    return self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+
+  def post(self, webhook, text):
+    session = self.session(webhook)
+    for attempt in range(self.retries + 1):
+      response = None
+      try:
+        response = session.post(webhook, json={ "text": text }, timeout=self.timeout)
+        if response.status_code not in RETRIED_CODES:
+          response.raise_for_status()
+          return
+        error = "HTTP " + str(response.status_code)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        error = str(e)
+      if attempt < self.retries:
+        delay = self.retryDelay(attempt, response)
+        logging.warning("Slack webhook " + urlsplit(webhook).netloc + " failed (" + error + "), retrying in " + str(round(delay, 1)) + "s")
+        time.sleep(delay)
+    raise slackError("could not post to slack after " + str(self.retries + 1) + " attempts: " + error)
+
+  # Post the message to all the webhooks at once, raise a slackError if any of them failed
+  def send(self, webhooks, text):
+    start = time.time()
+    futures = [ self.executor.submit(self.post, webhook, text) for webhook in webhooks ]
+    errors = []
+    for future in futures:
+      try:
+        future.result()
+      except (requests.RequestException, slackError) as e:
+        errors.append(str(e))
+    self.latency.observe(time.time() - start)
+    with self.lock:
+      if len(errors) > 0:
+        self.failed += 1
+      else:
+        self.sent += 1
+    if len(errors) > 0:
+      raise slackError(str(len(errors)) + "/" + str(len(webhooks)) + " webhooks failed: " + "; ".join(errors))
+
+  def stats(self):
+    with self.lock:
+      return { "sent": self.sent, "failed": self.failed }
+
+# Slack accepts about one message per second per webhook: instead of posting every
+# report, reports are collected during `window` seconds and posted as a single digest,
+# grouped by rule, directive and node, with their count and a few sample messages.
+# At most max_groups groups are kept, the reports of the other ones are only counted,
+# and the digest text is cut to max_length characters.
+# Reports routed to other webhooks than the configured ones get their own digest.
+# When a digest cannot be posted, on_failure is called with the keys of its reports and
+# its webhooks.
+class slackDigest:
+  def __init__(self, send, window=10, samples=3, max_groups=50, max_length=35000, on_failure=None):
+    self.send = send
+    self.on_failure = on_failure
+    self.window = window
+    self.samples = samples
+    self.max_groups = max_groups
+    self.max_length = max_length
+    self.lock = threading.Lock()
+    self.groups = {}
+    self.overflow = {}
+    self.keys = {}
+    self.start = time.time()
+    self.posted = 0
+    self.failed = 0
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, name="notify-slack-digest")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def configure(self, window, samples, max_groups):
+    self.window = window
+    self.samples = samples
+    self.max_groups = max_groups
+
+  # webhooks is None for the configured webhooks
+  def add(self, msgs, webhooks=None):
+    with self.lock:
+      keys = self.keys.setdefault(webhooks, set())
+      for msg in msgs:
+        keys.add(msg.key())
+        key = (webhooks, msg.rule_uuid, msg.directive_uuid, msg.node_uuid)
+        group = self.groups.get(key)
+        if group is None:
+          if len(self.groups) >= self.max_groups:
+            self.overflow[webhooks] = self.overflow.get(webhooks, 0) + 1
+            continue
+          group = [0, []]
+          self.groups[key] = group
+        group[0] += 1
+        if len(group[1]) < self.samples:
+          group[1].append(msg)
+
+  def pending(self):
+    with self.lock:
+      return sum(group[0] for group in self.groups.values()) + sum(self.overflow.values())
+
+  def stats(self):
+    return { "pending": self.pending(), "posted": self.posted, "failed": self.failed }
+
+  def format(self, groups, overflow, elapsed):
+    total = sum(count for (count, samples) in groups) + overflow
+    lines = [ "*RUDDER NON-COMPLIANCE* " + str(total) + " report" + ("s" if total > 1 else "") + " in the last " + str(int(elapsed)) + "s" ]
+    for (count, samples) in sorted(groups, key=lambda group: -group[0]):
+      first = samples[0]
+      lines.append("*" + str(count) + "x* Rule " + first.rule_name + " / Directive " + first.directive_name + " on " + first.node_fqdn + " (" + first.node_uuid + ")")
+      for msg in samples:
+        lines.append("    - [" + msg.result + "] " + msg.component_name + " " + msg.component_key + ": " + msg.message)
+    if overflow > 0:
+      lines.append("... and " + str(overflow) + " reports of other rules, directives or nodes")
+    text = "\n".join(lines)
+    if len(text) > self.max_length:
+      text = text[:self.max_length] + "\n... (truncated)"
+    return text
+
+  def flush(self):
+    with self.lock:
+      groups = self.groups
+      overflow = self.overflow
+      keys = self.keys
+      elapsed = time.time() - self.start
+      self.groups = {}
+      self.overflow = {}
+      self.keys = {}
+      self.start = time.time()
+    digests = { webhooks: [] for webhooks in overflow }
+    for ((webhooks, rule, directive, node), group) in groups.items():
+      digests.setdefault(webhooks, []).append(group)
+    for (webhooks, digestGroups) in digests.items():
+      try:
+        self.send(self.format(digestGroups, overflow.get(webhooks, 0), elapsed), webhooks)
+        self.posted += 1
+      except (requests.RequestException, slackError) as e:
+        self.failed += 1
+        logging.error("Could not post the slack digest: " + str(e))
+        if self.on_failure is not None:
+          self.on_failure(keys.get(webhooks, ()), webhooks)
+
+  def _run(self):
+    while not self.stopped.wait(max(self.window, 1)):
+      self.flush()
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+    self.flush()